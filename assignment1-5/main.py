@@ -45,6 +45,11 @@ def problem2():
     img_interpolated = interpolate(r, g, b)
     display_image(img_interpolated)
 
+    # compare the demosaicing methods on a full RGB image
+    img = load_image("data/a1p1.png")[:, :, :3]
+    for method, (quality, seconds) in comparedemosaic(img).items():
+        print("%-8s PSNR %5.2f dB  %6.1f ms" % (method, quality, 1000 * seconds))
+
 
 #
 # Problem 3: Projective Transformation
@@ -141,6 +146,13 @@ def problem4():
     plt.axis("off")
     plt.title("Non-maximum suppression")
 
+    # hysteresis thresholding
+    edges3 = canny(img, 0.1, threshold, fx, fy)
+    plt.figure()
+    plt.imshow(edges3, "gray", interpolation="none")
+    plt.axis("off")
+    plt.title("Canny edges")
+
     plt.show()
     print('end')
 
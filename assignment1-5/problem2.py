@@ -1,20 +1,55 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 from scipy.ndimage import convolve
 import matplotlib.pyplot as plt
 
-def loaddata(path):
+# (row, col) offsets of the red and blue sites within the 2x2 Bayer tile,
+# green occupies the two remaining sites
+CFA_PATTERNS = {
+    "GRBG": ((0, 1), (1, 0)),
+    "RGGB": ((0, 0), (1, 1)),
+    "BGGR": ((1, 1), (0, 0)),
+    "GBRG": ((1, 0), (0, 1)),
+}
+
+# border added around the bayer data, enough for the 5x5 neighbourhoods
+CFA_PAD = 2
+
+
+def loaddata(path, mmap_mode=None):
     """ Load bayerdata from file
 
     Args:
         Path of the .npy file
+        mmap_mode: if given, memory-map the file with this mode instead
+                   of reading it into memory, see np.load
     Returns:
         Bayer data as numpy array (H,W)
     """
 
-    return np.load(path)
+    return np.load(path, mmap_mode=mmap_mode)
+
+
+def cfaoffsets(pattern):
+    """ Look up the red and blue site offsets of a CFA layout
+
+    Args:
+        pattern: name of the CFA layout, e.g. "GRBG"
+    Returns:
+        (row, col) offsets of the red and the blue site
+    """
+
+    try:
+        return CFA_PATTERNS[pattern.upper()]
+    except KeyError:
+        raise ValueError("unknown CFA pattern %r, expected one of %s"
+                         % (pattern, ", ".join(CFA_PATTERNS)))
 
 
-def separatechannels(bayerdata):
+def separatechannels(bayerdata, pattern="GRBG", dtype=np.float64):
     """ Separate bayer data into RGB channels so that
     each color channel retains only the respective
     values given by the bayer pattern and missing values
@@ -22,23 +57,23 @@ def separatechannels(bayerdata):
 
     Args:
         Numpy array containing bayer data (H,W)
+        pattern: CFA layout of the 2x2 Bayer tile, one of CFA_PATTERNS
+        dtype: dtype of the returned channels
     Returns:
         red, green, and blue channel as numpy array (H,W)
     """
 
-    m = bayerdata.shape[0]
-    n = bayerdata.shape[1]
-    r_channel = np.zeros((m,n))         # np.zeros_like(bayerdata)
-    g_channel = np.zeros((m,n))
-    b_channel = np.zeros((m,n))
-    for i in range(m):
-        for j in range(n):
-            if i%2 == 0 and j%2 == 1:
-                r_channel[i, j] = bayerdata[i, j]
-            if i%2 == 1 and j%2 == 0:
-                b_channel[i, j] = bayerdata[i, j]
-            if (i%2 == 0 and j%2 == 0) or (i%2 == 1 and j%2 == 1):
-                g_channel[i, j] = bayerdata[i, j]
+    (ri, rj), (bi, bj) = cfaoffsets(pattern)
+    r_channel = np.zeros(bayerdata.shape, dtype=dtype)
+    g_channel = np.zeros(bayerdata.shape, dtype=dtype)
+    b_channel = np.zeros(bayerdata.shape, dtype=dtype)
+
+    # every color site repeats with period 2 in both directions, so each
+    # one is a single strided slice instead of a per-pixel test
+    r_channel[ri::2, rj::2] = bayerdata[ri::2, rj::2]
+    b_channel[bi::2, bj::2] = bayerdata[bi::2, bj::2]
+    g_channel[ri::2, 1-rj::2] = bayerdata[ri::2, 1-rj::2]
+    g_channel[bi::2, 1-bj::2] = bayerdata[bi::2, 1-bj::2]
 
     return r_channel, g_channel, b_channel
 
@@ -90,14 +125,391 @@ def interpolate(r, g, b):
     return image_inter
 
 
-data = loaddata("U:/学习系列/cv1/assignment1-5/data/bayerdata.npy")
-r, g, b = separatechannels(data)
+def mirrorpad(data, width, dtype):
+    """ Pad an array like mode='mirror' in interpolate, which keeps the
+    parity of the border pixels so the CFA layout simply continues outside
+
+    Args:
+        data: numpy array (H,W)
+        width: number of pixels added on each side
+        dtype: dtype of the padded array
+    Returns:
+        Padded numpy array (H+2*width,W+2*width)
+    """
+
+    # numpy's 'reflect' is ndimage's 'mirror', and like it reflects again
+    # on axes shorter than width
+    return np.pad(np.asarray(data, dtype=dtype), width, mode="reflect")
+
+
+def cfaneighbour(padded, i, j, di, dj, shape):
+    """ View on the neighbour (di, dj) of every CFA site at tile offset (i, j)
+
+    Args:
+        padded: bayer data padded by CFA_PAD pixels on each side
+        i, j: offset of the site within the 2x2 Bayer tile
+        di, dj: offset of the neighbour relative to the site
+        shape: shape of the site grid (H/2,W/2)
+    Returns:
+        Strided view into padded as numpy array (H/2,W/2)
+    """
+
+    h, w = shape
+    return padded[CFA_PAD+i+di::2, CFA_PAD+j+dj::2][:h, :w]
+
+
+def cfasites(padded, red, blue, out):
+    """ Iterate over the four sites of the 2x2 Bayer tile
+
+    Args:
+        padded: bayer data padded by CFA_PAD pixels on each side
+        red, blue: offsets of the red and the blue site, see cfaoffsets
+        out: output image (H,W,3)
+    Returns:
+        tuples (site, nb, green, c1, c2) for every site, where site is the
+        view of out on the site and nb(di, dj) the view on its neighbours.
+        For red/blue sites c1 and c2 are the known and the other color
+        channel, for green sites the channels of the colors left/right
+        and above/below
+    """
+
+    for i in range(2):
+        for j in range(2):
+            site = out[i::2, j::2]
+
+            def nb(di, dj, i=i, j=j, shape=site.shape[:2]):
+                return cfaneighbour(padded, i, j, di, dj, shape)
+
+            if (i, j) == red:
+                yield site, nb, False, 0, 2
+            elif (i, j) == blue:
+                yield site, nb, False, 2, 0
+            elif i == red[0]:
+                yield site, nb, True, 0, 2
+            else:
+                yield site, nb, True, 2, 0
+
+
+def demosaicbilinear(padded, red, blue, out):
+    """ Bilinear interpolation of the missing samples, as in interpolate
+
+    Args:
+        padded: bayer data padded by CFA_PAD pixels on each side
+        red, blue: offsets of the red and the blue site, see cfaoffsets
+        out: output image (H,W,3) the result is written to
+    """
+
+    for site, nb, green, c1, c2 in cfasites(padded, red, blue, out):
+        if green:
+            site[..., 1] = nb(0, 0)
+            site[..., c1] = (nb(0, -1) + nb(0, 1)) / 2
+            site[..., c2] = (nb(-1, 0) + nb(1, 0)) / 2
+        else:
+            site[..., c1] = nb(0, 0)
+            site[..., 1] = (nb(-1, 0) + nb(1, 0) + nb(0, -1) + nb(0, 1)) / 4
+            site[..., c2] = (nb(-1, -1) + nb(-1, 1) + nb(1, -1) + nb(1, 1)) / 4
+
+
+def demosaicmalvar(padded, red, blue, out):
+    """ Gradient-corrected linear interpolation (Malvar, He and Cutler),
+    the bilinear estimate is corrected by the Laplacian of the known channel
+
+    Args:
+        padded: bayer data padded by CFA_PAD pixels on each side
+        red, blue: offsets of the red and the blue site, see cfaoffsets
+        out: output image (H,W,3) the result is written to
+    """
+
+    for site, nb, green, c1, c2 in cfasites(padded, red, blue, out):
+        c = nb(0, 0)
+        if green:
+            diag = nb(-1, -1) + nb(-1, 1) + nb(1, -1) + nb(1, 1)
+            horiz = nb(0, -2) + nb(0, 2)
+            vert = nb(-2, 0) + nb(2, 0)
+            site[..., 1] = c
+            site[..., c1] = (5*c - diag - horiz + vert/2 + 4*(nb(0, -1) + nb(0, 1))) / 8
+            site[..., c2] = (5*c - diag - vert + horiz/2 + 4*(nb(-1, 0) + nb(1, 0))) / 8
+        else:
+            ring = nb(-2, 0) + nb(2, 0) + nb(0, -2) + nb(0, 2)
+            cross = nb(-1, 0) + nb(1, 0) + nb(0, -1) + nb(0, 1)
+            diag = nb(-1, -1) + nb(-1, 1) + nb(1, -1) + nb(1, 1)
+            site[..., c1] = c
+            site[..., 1] = (4*c - ring + 2*cross) / 8
+            site[..., c2] = (6*c - 1.5*ring + 2*diag) / 8
+
+
+def demosaicedge(padded, red, blue, out):
+    """ Edge-directed interpolation (Hamilton and Adams). Green is
+    interpolated along the direction with the smaller gradient, red and
+    blue bilinearly on their difference to the interpolated green
+
+    Args:
+        padded: bayer data padded by CFA_PAD pixels on each side
+        red, blue: offsets of the red and the blue site, see cfaoffsets
+        out: output image (H,W,3) the result is written to
+    """
+
+    for site, nb, green, c1, c2 in cfasites(padded, red, blue, out):
+        c = nb(0, 0)
+        if green:
+            site[..., 1] = c
+        else:
+            lh = 2*c - nb(0, -2) - nb(0, 2)
+            lv = 2*c - nb(-2, 0) - nb(2, 0)
+            dh = np.abs(nb(0, -1) - nb(0, 1)) + np.abs(lh)
+            dv = np.abs(nb(-1, 0) - nb(1, 0)) + np.abs(lv)
+            gh = (nb(0, -1) + nb(0, 1) + lh / 2) / 2
+            gv = (nb(-1, 0) + nb(1, 0) + lv / 2) / 2
+            # no preferred direction, fall back to the average of both
+            tie = dh == dv
+            gh[tie] = (gh[tie] + gv[tie]) / 2
+            site[..., 1] = np.where(dh <= dv, gh, gv)
+            site[..., c1] = c
+
+    # red - green and blue - green at the red and blue sites, zero at green
+    diff = padded - mirrorpad(out[..., 1], CFA_PAD, out.dtype)
+    for site, nb, green, c1, c2 in cfasites(diff, red, blue, out):
+        g = site[..., 1]
+        if green:
+            site[..., c1] = g + (nb(0, -1) + nb(0, 1)) / 2
+            site[..., c2] = g + (nb(-1, 0) + nb(1, 0)) / 2
+        else:
+            site[..., c2] = g + (nb(-1, -1) + nb(-1, 1) + nb(1, -1) + nb(1, 1)) / 4
+
+
+# demosaicing method and the distance of the farthest mosaic pixel it reads
+DEMOSAIC_METHODS = {
+    "bilinear": (demosaicbilinear, 1),
+    "malvar": (demosaicmalvar, 2),
+    "edge": (demosaicedge, 3),
+}
+
+
+def demosaicmethod(method):
+    """ Look up a demosaicing method
+
+    Args:
+        method: name of the method, one of DEMOSAIC_METHODS
+    Returns:
+        the demosaicing function and its reach in pixels
+    """
+
+    try:
+        return DEMOSAIC_METHODS[method]
+    except KeyError:
+        raise ValueError("unknown demosaicing method %r, expected one of %s"
+                         % (method, ", ".join(DEMOSAIC_METHODS)))
+
+
+def demosaic(bayerdata, pattern="GRBG", dtype=np.float64, out=None, method="bilinear"):
+    """ Demosaicing straight from the bayer data to the RGB image. With the
+    bilinear method this gives the same result as
+    interpolate(*separatechannels(bayerdata)), but only the missing samples
+    of each CFA site are computed and they are written into a single
+    output buffer
+
+    Args:
+        bayerdata: numpy array containing bayer data (H,W)
+        pattern: CFA layout of the 2x2 Bayer tile, one of CFA_PATTERNS
+        dtype: floating point dtype of the result
+        out: optional preallocated output array (H,W,3)
+        method: demosaicing method, one of DEMOSAIC_METHODS
+    Returns:
+        Interpolated image as numpy array (H,W,3)
+    """
+
+    red, blue = cfaoffsets(pattern)
+    interpolatesites = demosaicmethod(method)[0]
+    m, n = bayerdata.shape
+    if m < 2 or n < 2:
+        # mirroring a single row or column breaks the parity of the CFA layout
+        raise ValueError("demosaic needs at least 2 rows and 2 columns, got %dx%d" % (m, n))
+    if out is None:
+        out = np.empty((m, n, 3), dtype=dtype)
+    if not np.issubdtype(out.dtype, np.floating):
+        raise ValueError("demosaic needs a floating point output dtype")
+
+    interpolatesites(mirrorpad(bayerdata, CFA_PAD, out.dtype), red, blue, out)
+
+    return out
+
+
+def mosaic(img, pattern="GRBG"):
+    """ Sample an RGB image with the bayer pattern, the inverse of demosaicing
+
+    Args:
+        img: image as numpy array (H,W,3)
+        pattern: CFA layout of the 2x2 Bayer tile, one of CFA_PATTERNS
+    Returns:
+        Bayer data as numpy array (H,W)
+    """
+
+    (ri, rj), (bi, bj) = cfaoffsets(pattern)
+    bayerdata = img[..., 1].copy()
+    bayerdata[ri::2, rj::2] = img[ri::2, rj::2, 0]
+    bayerdata[bi::2, bj::2] = img[bi::2, bj::2, 2]
+
+    return bayerdata
+
+
+def psnr(img, ref, peak=1.0):
+    """ Peak signal-to-noise ratio of an image with respect to a reference
+
+    Args:
+        img, ref: images as numpy arrays of the same shape
+        peak: maximum possible pixel value
+    Returns:
+        PSNR in dB
+    """
+
+    mse = np.mean((np.asarray(img, dtype=np.float64) - ref)**2)
+    return 10 * np.log10(peak**2 / mse) if mse > 0 else np.inf
+
+
+def comparedemosaic(img, pattern="GRBG", methods=None, repeat=3):
+    """ Compare the demosaicing methods on an RGB image that is mosaiced
+    with the bayer pattern and then reconstructed by each of them
+
+    Args:
+        img: reference image as numpy array (H,W,3) with values in [0, 1]
+        pattern: CFA layout of the 2x2 Bayer tile, one of CFA_PATTERNS
+        methods: names of the methods to compare, default all of them
+        repeat: number of runs, the fastest one is reported
+    Returns:
+        dict from method name to (PSNR in dB, time in seconds)
+    """
+
+    bayerdata = mosaic(img, pattern)
+    results = {}
+    for method in methods or DEMOSAIC_METHODS:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rgb = demosaic(bayerdata, pattern, method=method)
+            times.append(time.perf_counter() - start)
+        results[method] = (psnr(rgb, img), min(times))
+
+    return results
+
+
+def demosaictiled(path, outpath, bandrows=1024, pattern="GRBG", dtype=np.float64,
+                  method="bilinear"):
+    """ Demosaic a bayer .npy file band by band into a memory-mapped
+    .npy output, so that memory use only depends on the band size.
+    Gives the same result as demosaic(loaddata(path))
+
+    Args:
+        path: path of the .npy file containing bayer data (H,W)
+        outpath: path of the .npy file the RGB image is written to
+        bandrows: number of image rows demosaiced at once
+        pattern: CFA layout of the 2x2 Bayer tile, one of CFA_PATTERNS
+        dtype: floating point dtype of the result
+        method: demosaicing method, one of DEMOSAIC_METHODS
+    Returns:
+        Interpolated image as memory-mapped numpy array (H,W,3)
+    """
+
+    bayerdata = loaddata(path, mmap_mode="r")
+    m, n = bayerdata.shape
+    out = np.lib.format.open_memmap(outpath, mode="w+", dtype=dtype, shape=(m, n, 3))
+
+    # the halo covers the reach of the method, rounded up to an even number
+    # of rows so that every band keeps the CFA layout of the image
+    halo = demosaicmethod(method)[1]
+    halo += halo % 2
+    bandrows += bandrows % 2
+    band = np.empty((bandrows + 2*halo, n, 3), dtype=dtype)
+    for r0 in range(0, m, bandrows):
+        r1 = min(r0 + bandrows, m)
+        lo, hi = max(r0 - halo, 0), min(r1 + halo, m)
+        demosaic(bayerdata[lo:hi], pattern, out=band[:hi-lo], method=method)
+        out[r0:r1] = band[r0-lo:r1-lo]
+    out.flush()
+
+    return out
+
+
+def demosaicframe(frame, path, pattern="GRBG", dtype=np.float64, method="bilinear"):
+    """ Demosaic a single bayer frame and save the RGB image
+
+    Args:
+        frame: bayer data (H,W) or path of its .npy file
+        path: path of the .npy file the RGB image is written to
+        pattern: CFA layout of the 2x2 Bayer tile, one of CFA_PATTERNS
+        dtype: floating point dtype of the result
+        method: demosaicing method, one of DEMOSAIC_METHODS
+    Returns:
+        path of the written file
+    """
+
+    if isinstance(frame, (str, os.PathLike)):
+        frame = loaddata(frame)
+    np.save(path, demosaic(frame, pattern, dtype, method=method))
+
+    return path
+
+
+def demosaicbatch(frames, outdir, workers=4, processes=False, maxinflight=None,
+                  pattern="GRBG", dtype=np.float64, method="bilinear"):
+    """ Demosaic a sequence of bayer frames with a pool of workers and
+    stream the RGB images to outdir as they finish. Frames are completed
+    in input order and at most maxinflight of them are queued or being
+    processed at any time, so memory stays bounded for long sequences
+
+    Args:
+        frames: directory of .npy files, or an iterable of .npy paths
+                or bayer data arrays (H,W)
+        outdir: directory the RGB images are written to
+        workers: number of worker threads or processes
+        processes: use a process pool instead of a thread pool
+        maxinflight: maximum number of submitted frames, default 2*workers
+        pattern: CFA layout of the 2x2 Bayer tile, one of CFA_PATTERNS
+        dtype: floating point dtype of the result
+        method: demosaicing method, one of DEMOSAIC_METHODS
+    Returns:
+        number of demosaiced frames and the throughput in frames per second
+    """
+
+    if isinstance(frames, (str, os.PathLike)):
+        frames = [os.path.join(frames, f) for f in sorted(os.listdir(frames))
+                  if f.endswith(".npy")]
+    if maxinflight is None:
+        maxinflight = 2 * workers
+    os.makedirs(outdir, exist_ok=True)
+
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    pending = deque()
+    count = 0
+    start = time.perf_counter()
+    with executor(max_workers=workers) as pool:
+        for k, frame in enumerate(frames):
+            if isinstance(frame, (str, os.PathLike)):
+                name = os.path.basename(frame)
+            else:
+                name = "frame%06d.npy" % k
+            pending.append(pool.submit(demosaicframe, frame,
+                                       os.path.join(outdir, name), pattern, dtype, method))
+            # wait for the oldest frame before reading further ahead
+            while len(pending) >= maxinflight:
+                pending.popleft().result()
+                count += 1
+        while pending:
+            pending.popleft().result()
+            count += 1
+    elapsed = time.perf_counter() - start
+
+    return count, count / elapsed if elapsed > 0 else 0.0
+
+
+if __name__ == "__main__":
+    data = loaddata("U:/学习系列/cv1/assignment1-5/data/bayerdata.npy")
+    r, g, b = separatechannels(data)
 
-img = assembleimage(r, g, b)
-plt.imshow(img)
+    img = assembleimage(r, g, b)
+    plt.imshow(img)
 
-print('interpolation')
-img_interpolated = interpolate(r, g, b)
-plt.imshow(img_interpolated)
+    print('interpolation')
+    img_interpolated = interpolate(r, g, b)
+    plt.imshow(img_interpolated)
 
-print('end')
+    print('end')
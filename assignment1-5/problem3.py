@@ -1,4 +1,9 @@
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import scipy.linalg
+from scipy import ndimage
 import matplotlib.pyplot as plt
 
 
@@ -178,6 +183,166 @@ def getfullprojection(T, Rx, Ry, Rz, L):
   return P, M
 
 
+def getrotations(dx, dy, dz):
+  """ Returns the rotations Rz Rx Ry of getfullprojection for arrays of angles.
+
+  Args:
+    dx, dy, dz: degrees of the rotations around the x, y and z axis, broadcastable arrays
+
+  Returns:
+    R: (... x 3 x 3) rotation matrices
+  """
+
+  ax, ay, az = np.broadcast_arrays(*(np.radians(d) for d in (dx, dy, dz)))
+  cx, sx = np.cos(ax), np.sin(ax)
+  cy, sy = np.cos(ay), np.sin(ay)
+  cz, sz = np.cos(az), np.sin(az)
+
+  # closed-form product Rz.dot(Rx).dot(Ry)
+  R = np.empty(ax.shape + (3, 3))
+  R[..., 0, 0] = cz * cy - sz * sx * sy
+  R[..., 0, 1] = -sz * cx
+  R[..., 0, 2] = cz * sy + sz * sx * cy
+  R[..., 1, 0] = sz * cy + cz * sx * sy
+  R[..., 1, 1] = cz * cx
+  R[..., 1, 2] = sz * sy - cz * sx * cy
+  R[..., 2, 0] = -cx * sy
+  R[..., 2, 1] = sx
+  R[..., 2, 2] = cx * cy
+
+  return R
+
+
+class RigidTransform(object):
+  """ Rigid transformation X -> R X + t. With R of shape (K x 3 x 3) and t of
+  shape (K x 3) one object holds a whole trajectory of K poses, and all
+  operations work on all poses at once.
+  """
+
+  __slots__ = ("R", "t")
+
+  def __init__(self, R, t):
+    self.R = np.asarray(R, dtype=np.float64)
+    self.t = np.asarray(t, dtype=np.float64)
+
+  @classmethod
+  def fromangles(cls, dx, dy, dz, v):
+    """ Transformation M = Rz Rx Ry T of getfullprojection.
+
+    Args:
+      dx, dy, dz: degrees of the rotations, scalars or (K,) arrays
+      v: 3d translation vector, (3,) or (K x 3)
+
+    Returns:
+      the transformation, cached for scalar parameters
+    """
+
+    if np.ndim(dx) == np.ndim(dy) == np.ndim(dz) == 0 and np.ndim(v) == 1:
+      return cachedpose(float(dx), float(dy), float(dz), tuple(np.asarray(v, dtype=np.float64)))
+    R = getrotations(dx, dy, dz)
+    return cls(R, np.matmul(R, np.asarray(v, dtype=np.float64)[..., None])[..., 0])
+
+  @classmethod
+  def fromquaternion(cls, q, t):
+    """ Transformation from unit quaternions (w, x, y, z).
+
+    Args:
+      q: (4,) or (K x 4) quaternions, normalized here
+      t: (3,) or (K x 3) translations
+    """
+
+    q = np.asarray(q, dtype=np.float64)
+    w, x, y, z = np.moveaxis(q / np.linalg.norm(q, axis=-1, keepdims=True), -1, 0)
+    R = np.empty(w.shape + (3, 3))
+    R[..., 0, 0] = 1 - 2 * (y * y + z * z)
+    R[..., 0, 1] = 2 * (x * y - z * w)
+    R[..., 0, 2] = 2 * (x * z + y * w)
+    R[..., 1, 0] = 2 * (x * y + z * w)
+    R[..., 1, 1] = 1 - 2 * (x * x + z * z)
+    R[..., 1, 2] = 2 * (y * z - x * w)
+    R[..., 2, 0] = 2 * (x * z - y * w)
+    R[..., 2, 1] = 2 * (y * z + x * w)
+    R[..., 2, 2] = 1 - 2 * (x * x + y * y)
+    return cls(R, t)
+
+  def quaternion(self):
+    """ Returns the rotations as (4,) or (K x 4) unit quaternions (w, x, y, z)
+    with w >= 0, using Shepperd's method: the largest component is taken from
+    the diagonal and the others from the off-diagonal sums and differences.
+    """
+
+    R = self.R
+    d0, d1, d2 = R[..., 0, 0], R[..., 1, 1], R[..., 2, 2]
+    sx, dx = R[..., 2, 1] + R[..., 1, 2], R[..., 2, 1] - R[..., 1, 2]
+    sy, dy = R[..., 0, 2] + R[..., 2, 0], R[..., 0, 2] - R[..., 2, 0]
+    sz, dz = R[..., 1, 0] + R[..., 0, 1], R[..., 1, 0] - R[..., 0, 1]
+
+    # 4 w^2, 4 x^2, 4 y^2, 4 z^2 and the quaternions scaled by 4 w, 4 x, 4 y, 4 z
+    t = np.stack([1 + d0 + d1 + d2, 1 + d0 - d1 - d2, 1 - d0 + d1 - d2, 1 - d0 - d1 + d2], axis=-1)
+    candidates = [np.stack(c, axis=-1) for c in ((t[..., 0], dx, dy, dz),
+                                                 (dx, t[..., 1], sz, sy),
+                                                 (dy, sz, t[..., 2], sx),
+                                                 (dz, sy, sx, t[..., 3]))]
+    largest = np.argmax(t, axis=-1)[..., None]
+    q = np.select([largest == k for k in range(4)], candidates)
+    q = q / (2 * np.sqrt(np.take_along_axis(t, largest, -1)))
+    return np.where(q[..., :1] < 0, -q, q)
+
+  def __len__(self):
+    return len(self.R) if self.R.ndim == 3 else 1
+
+  def __getitem__(self, k):
+    return RigidTransform(self.R[k], self.t[k])
+
+  def __matmul__(self, other):
+    return self.compose(other)
+
+  def compose(self, other):
+    """ Returns the transformation applying other first and then self. """
+
+    return RigidTransform(np.matmul(self.R, other.R),
+                          np.matmul(self.R, other.t[..., None])[..., 0] + self.t)
+
+  def inverse(self):
+    """ Returns the inverse transformation (R^T, -R^T t). """
+
+    Rt = np.swapaxes(self.R, -1, -2)
+    return RigidTransform(Rt, -np.matmul(Rt, self.t[..., None])[..., 0])
+
+  def apply(self, X):
+    """ Apply the transformation to 3D points.
+
+    Args:
+      X: (3 x N) 3d points in cartesian coordinates
+
+    Returns:
+      (3 x N) transformed points, (K x 3 x N) for a trajectory
+    """
+
+    return np.matmul(self.R, X) + self.t[..., None]
+
+  def matrix(self):
+    """ Returns the (4 x 4) matrix in homogeneous coordinates, (K x 4 x 4) for a trajectory. """
+
+    M = np.zeros(self.R.shape[:-2] + (4, 4))
+    M[..., :3, :3] = self.R
+    M[..., :3, 3] = self.t
+    M[..., 3, 3] = 1
+
+    return M
+
+
+@functools.lru_cache(maxsize=1024)
+def cachedpose(dx, dy, dz, v):
+  """ Cached RigidTransform.fromangles for scalar parameters, the arrays are read-only. """
+
+  pose = RigidTransform.fromangles(np.array([dx]), np.array([dy]), np.array([dz]), np.array([v]))[0]
+  pose.R.setflags(write=False)
+  pose.t.setflags(write=False)
+
+  return pose
+
+
 def projectpoints(P, X):
   """ Apply full projection matrix P to 3D points X in cartesian coordinates.
 
@@ -195,6 +360,222 @@ def projectpoints(P, X):
 
   return x
 
+def projectpointsbatch(P, X, dtype=np.float64):
+  """ Apply K projection matrices P to the same 3D points X in cartesian coordinates.
+  The points are mapped with the (3 x 3) part of each P plus its translation
+  column, so no homogeneous copy of X is built.
+
+  Args:
+    P: (K x 3 x 4) stack of projection matrices
+    X: (3 x N) 3d points in cartesian coordinates
+    dtype: dtype of the computation and the result
+
+  Returns:
+    x: (K x 2 x N) 2d points in cartesian coordinates for every camera
+  """
+
+  P = np.asarray(P, dtype=dtype)
+  X = np.asarray(X, dtype=dtype)
+  # stack the (3 x 3) blocks of all cameras into one (3K x 3) matrix product
+  X_pro = P[:, :, :3].reshape(-1, 3).dot(X).reshape(len(P), 3, -1)
+  X_pro += P[:, :, 3:]
+  X_pro[:, :2] /= X_pro[:, 2:]
+
+  return X_pro[:, :2]
+
+def distortnormalized(x, coeffs):
+  """ Apply the Brown-Conrady lens distortion to normalized image coordinates.
+
+  Args:
+    x: (2 x ...) normalized image coordinates K^-1 [x, y, 1]
+    coeffs: distortion coefficients (k1, k2, p1, p2[, k3]), radial k and tangential p
+
+  Returns:
+    xd: (2 x ...) distorted normalized image coordinates
+  """
+
+  k1, k2, p1, p2, k3 = tuple(coeffs) + (0.0,) * (5 - len(coeffs))
+  u, v = x
+  r2 = u * u + v * v
+  radial = 1 + r2 * (k1 + r2 * (k2 + r2 * k3))
+  uv = 2 * u * v
+
+  return np.stack([u * radial + p1 * uv + p2 * (r2 + 2 * u * u),
+                   v * radial + p1 * (r2 + 2 * v * v) + p2 * uv])
+
+
+def distortpoints(x, L, coeffs):
+  """ Apply the lens distortion to ideal pinhole image points, e.g. the
+  output of projectpoints, to get the points a real camera observes.
+
+  Args:
+    x: (2 x N) 2d image points in cartesian coordinates
+    L: central projection matrix
+    coeffs: distortion coefficients (k1, k2, p1, p2[, k3])
+
+  Returns:
+    xd: (2 x N) distorted 2d image points
+  """
+
+  K = np.asarray(L, dtype=np.float64)[:, :3]
+  Kinv = intrinsicsinverse(K)
+  xn = Kinv[:2, :2].dot(x) + Kinv[:2, 2:]
+  xd = distortnormalized(xn, coeffs)
+
+  return K[:2, :2].dot(xd) + K[:2, 2:]
+
+
+def undistortmap(L, coeffs, shape):
+  """ Returns the lookup table for undistorting images of shape (H, W): for every
+  pixel of the undistorted image the (row, col) position in the distorted image
+  it is sampled from. Pixel (i, j) has image coordinates x = j, y = i.
+  The table is computed once per camera and cached.
+
+  Args:
+    L: central projection matrix
+    coeffs: distortion coefficients (k1, k2, p1, p2[, k3])
+    shape: (H, W) of the images
+
+  Returns:
+    coords: (2 x H x W) read-only sampling coordinates for ndimage.map_coordinates
+  """
+
+  K = np.ascontiguousarray(np.asarray(L, dtype=np.float64)[:, :3])
+  return cachedundistortmap(K.tobytes(), tuple(map(float, coeffs)), tuple(shape))
+
+
+@functools.lru_cache(maxsize=8)
+def cachedundistortmap(Lkey, coeffs, shape):
+  """ Cached part of undistortmap, Lkey is the bytes of the (3 x 3) block of L. """
+
+  h, w = shape
+  y, x = np.mgrid[0:h, 0:w].astype(np.float64)
+  xd = distortpoints(np.stack([x.ravel(), y.ravel()]), np.frombuffer(Lkey).reshape(3, 3), coeffs)
+  coords = xd[::-1].reshape(2, h, w)
+  coords.setflags(write=False)
+
+  return coords
+
+
+def undistortimage(img, L, coeffs, order=1):
+  """ Undistort an image with the cached lookup table of undistortmap,
+  so every frame costs a single remap.
+
+  Args:
+    img: (H x W) or (H x W x C) image taken with the distorted camera
+    L: central projection matrix
+    coeffs: distortion coefficients (k1, k2, p1, p2[, k3])
+    order: spline order of the interpolation, see ndimage.map_coordinates
+
+  Returns:
+    the undistorted image, same shape as img
+  """
+
+  coords = undistortmap(L, coeffs, img.shape[:2])
+  if img.ndim == 2:
+    return ndimage.map_coordinates(img, coords, order=order, mode='constant')
+
+  out = np.empty_like(img)
+  for c in range(img.shape[2]):
+    ndimage.map_coordinates(img[..., c], coords, output=out[..., c], order=order, mode='constant')
+
+  return out
+
+
+def projectchunk(X, R, t, K, shape, near):
+  """ Project a chunk of points for renderframes and cull them.
+
+  Args:
+    X: (3 x n) 3d points in cartesian coordinates
+    R, t: rotation and translation of the extrinsic transformation
+    K: (3 x 3) intrinsic block of the central projection matrix
+    shape: (H, W) of the image
+    near: points with a camera z-coordinate up to near are culled
+
+  Returns:
+    x: 2d points inside the image
+    idx: flat pixel index of each point
+    z: camera z-coordinate of each point
+  """
+
+  h, w = shape
+  Xc = R.dot(X)
+  Xc += t[:, None]
+  Xc = Xc[:, Xc[2] > near]
+  x = K.dot(Xc)
+  x = x[:2] / x[2]
+
+  col = np.floor(x[0] + 0.5).astype(np.intp)
+  row = np.floor(x[1] + 0.5).astype(np.intp)
+  inside = (col >= 0) & (col < w) & (row >= 0) & (row < h)
+
+  return x[:, inside], row[inside] * w + col[inside], Xc[2, inside]
+
+
+def renderframes(X, poses, L, shape, near=1e-6, chunksize=65536, workers=None):
+  """ Render a point set for a stream of camera poses. For every pose the points
+  are projected in chunks of at most chunksize points, points behind the camera
+  or outside the image are culled and the rest is rasterized into a depth buffer.
+
+  Args:
+    X: (3 x N) 3d world points in cartesian coordinates
+    poses: iterable of (4 x 4) extrinsic matrices M or RigidTransforms
+    L: central projection matrix
+    shape: (H, W) of the image buffer
+    near: points with a camera z-coordinate up to near are culled
+    chunksize: number of points projected at once
+    workers: number of threads the chunks are distributed to, None to project in this thread
+
+  Returns:
+    generator of tuples (x, depth) for every pose, with the (2 x n) projected
+    points inside the image and the (H x W) depth buffer holding the nearest
+    depth per pixel and inf where no point was projected
+  """
+
+  h, w = shape
+  K = np.asarray(L, dtype=np.float64)[:, :3]
+  chunks = [X[:, k:k + chunksize] for k in range(0, X.shape[1], chunksize)]
+  # matmul releases the GIL, so the chunks of a frame can be projected in parallel
+  pool = ThreadPoolExecutor(max_workers=workers) if workers else None
+  try:
+    for pose in poses:
+      if isinstance(pose, RigidTransform):
+        R, t = pose.R, pose.t
+      else:
+        R, t = pose[:3, :3], pose[:3, 3]
+      task = functools.partial(projectchunk, R=R, t=t, K=K, shape=shape, near=near)
+
+      depth = np.full(h * w, np.inf)
+      points = [np.empty((2, 0))]
+      for x, idx, z in (pool.map(task, chunks) if pool else map(task, chunks)):
+        np.minimum.at(depth, idx, z)
+        points.append(x)
+
+      yield np.concatenate(points, axis=1), depth.reshape(h, w)
+  finally:
+    if pool:
+      pool.shutdown()
+
+
+def measurefps(frames):
+  """ Consume a stream of frames, e.g. from renderframes, and measure the throughput.
+
+  Args:
+    frames: iterable of rendered frames
+
+  Returns:
+    number of frames and frames per second
+  """
+
+  count = 0
+  start = time.perf_counter()
+  for _ in frames:
+    count += 1
+  elapsed = time.perf_counter() - start
+
+  return count, count / elapsed if elapsed > 0 else 0.0
+
+
 def loadpoints():
   """ Load 2D points from obj2d.npy.
 
@@ -228,9 +609,11 @@ def invertprojection(L, P2d, z):
     P3d: 3d cartesian camera coordinates of the points
   """
 
-  P2d_hom = P2d * z
-  L = np.delete(L, -1, axis=1)
-  P3d = np.linalg.inv(L).dot(np.concatenate((P2d_hom, z), axis=0))
+  # K^-1 [x*z, y*z, z] = z * (K^-1[:, :2] [x, y] + K^-1[:, 2])
+  Kinv = intrinsicsinverse(L)
+  P3d = Kinv[:, :2].dot(P2d)
+  P3d += Kinv[:, 2:]
+  P3d *= z
 
   return P3d
 
@@ -247,12 +630,380 @@ def inverttransformation(M, P3d):
     X: 3d points after the extrinsic transformations have been reverted
   """
 
-  P3d_hom = cart2hom(P3d)
-  X = np.linalg.inv(M).dot(P3d_hom)
+  Minv = extrinsicsinverse(M)
+  X = np.empty((4, P3d.shape[1]))
+  np.dot(Minv[:3, :3], P3d, out=X[:3])
+  X[:3] += Minv[:3, 3:]
+  X[3] = 1
 
   return X
 
 
+def backproject(L, M, P2d, z):
+  """ Invert the full projection of cartesian image coordinates P2d with
+  z-coordinates z, i.e. invertprojection and inverttransformation in one step.
+
+  Args:
+    L: central projection matrix
+    M: matrix summarizing the extrinsic transformations
+    P2d: 2d image coordinates of the projected points
+    z: z-components of the homogeneous image coordinates
+
+  Returns:
+    X: 3d world points in cartesian coordinates
+  """
+
+  # X = R^T K^-1 [x*z, y*z, z] - R^T t with A = R^T K^-1
+  Kinv = intrinsicsinverse(L)
+  Minv = extrinsicsinverse(M)
+  A = Minv[:3, :3].dot(Kinv)
+  X = A[:, :2].dot(P2d)
+  X += A[:, 2:]
+  X *= z
+  X += Minv[:3, 3:]
+
+  return X
+
+
+def depthtopointcloud(depth, L, M, dtype=np.float64):
+  """ Back-project a dense depth map to a point cloud in world coordinates.
+  Pixel (i, j) has image coordinates x = j, y = i. The world ray of every pixel is
+  cached per resolution and camera, so a new frame costs a single multiply-add.
+
+  Args:
+    depth: (H x W) z-components of the homogeneous image coordinates
+    L: central projection matrix
+    M: matrix summarizing the extrinsic transformations
+    dtype: dtype of the point cloud, e.g. np.float32 to halve memory
+
+  Returns:
+    X: (H*W x 3) 3d world points in cartesian coordinates, in row-major pixel order
+  """
+
+  L = np.ascontiguousarray(np.asarray(L, dtype=np.float64)[:, :3])
+  M = np.ascontiguousarray(M, dtype=np.float64)
+  rays, center = worldrays(depth.shape, L.tobytes(), M.tobytes(), np.dtype(dtype).str)
+
+  X = depth.reshape(-1, 1).astype(dtype, copy=False) * rays
+  X += center
+
+  return X
+
+
+@functools.lru_cache(maxsize=4)
+def camerarays(shape, Lkey, dtype):
+  """ Returns the (H*W x 3) camera coordinates K^-1 [x, y, 1] of all pixels, read-only. """
+
+  h, w = shape
+  Kinv = intrinsicsinverse(np.frombuffer(Lkey).reshape(3, 3))
+  # K^-1 [x, y, 1] = K^-1[:, 0] x + K^-1[:, 1] y + K^-1[:, 2], built per row and column
+  rays = (Kinv[:, 0] * np.arange(w)[:, None])[None, :, :] \
+    + (Kinv[:, 1] * np.arange(h)[:, None])[:, None, :] + Kinv[:, 2]
+  rays = rays.reshape(-1, 3).astype(np.dtype(dtype))
+  rays.setflags(write=False)
+
+  return rays
+
+
+@functools.lru_cache(maxsize=4)
+def worldrays(shape, Lkey, Mkey, dtype):
+  """ Returns the world directions R^T K^-1 [x, y, 1] of all pixels and
+  the camera center -R^T t, both read-only. """
+
+  Minv = extrinsicsinverse(np.frombuffer(Mkey).reshape(4, 4))
+  rays = camerarays(shape, Lkey, dtype).dot(Minv[:3, :3].T.astype(np.dtype(dtype)))
+  center = Minv[:3, 3].astype(np.dtype(dtype))
+  rays.setflags(write=False)
+  center.setflags(write=False)
+
+  return rays, center
+
+
+def intrinsicsinverse(L):
+  """ Returns the inverse of the (3 x 3) intrinsic block of L, computed in
+  closed form for the upper triangular L of getcentralprojection and cached
+  per camera.
+
+  Args:
+    L: central projection matrix
+
+  Returns:
+    Kinv: (3 x 3) inverse of L[:, :3], read-only
+  """
+
+  K = np.ascontiguousarray(np.asarray(L, dtype=np.float64)[:, :3])
+  return cachedintrinsicsinverse(K.tobytes())
+
+
+@functools.lru_cache(maxsize=64)
+def cachedintrinsicsinverse(key):
+  """ Cached part of intrinsicsinverse, key is the bytes of the (3 x 3) block. """
+
+  K = np.frombuffer(key).reshape(3, 3)
+  if np.any(np.tril(K, -1)):
+    Kinv = np.linalg.inv(K)
+  else:
+    (a, s, c), (_, b, d), (_, _, e) = K
+    Kinv = np.array([[1 / a, -s / (a * b), (s * d - c * b) / (a * b * e)],
+                     [0, 1 / b, -d / (b * e)],
+                     [0, 0, 1 / e]])
+  Kinv.setflags(write=False)
+
+  return Kinv
+
+
+def extrinsicsinverse(M):
+  """ Returns the inverse of the extrinsic transformation M, computed in
+  closed form as [R^T, -R^T t] for a rigid M and cached per camera.
+
+  Args:
+    M: (4 x 4) matrix summarizing the extrinsic transformations
+
+  Returns:
+    Minv: (4 x 4) inverse of M, read-only
+  """
+
+  M = np.ascontiguousarray(M, dtype=np.float64)
+  return cachedextrinsicsinverse(M.tobytes())
+
+
+@functools.lru_cache(maxsize=64)
+def cachedextrinsicsinverse(key):
+  """ Cached part of extrinsicsinverse, key is the bytes of M. """
+
+  M = np.frombuffer(key).reshape(4, 4)
+  R, t = M[:3, :3], M[:3, 3]
+  if np.allclose(R.T.dot(R), np.identity(3)) and np.array_equal(M[3], [0, 0, 0, 1]):
+    Minv = np.identity(4)
+    Minv[:3, :3] = R.T
+    Minv[:3, 3] = -R.T.dot(t)
+  else:
+    Minv = np.linalg.inv(M)
+  Minv.setflags(write=False)
+
+  return Minv
+
+
+def normalizationmatrix(points):
+  """ Returns the similarity transformation that moves the centroid of the points
+  to the origin and scales their mean distance to it to sqrt(d) (Hartley normalization).
+
+  Args:
+    points: (d x N) points in cartesian coordinates
+
+  Returns:
+    T: (d+1 x d+1) normalizing transformation in homogeneous coordinates
+  """
+
+  d = points.shape[0]
+  center = points.mean(axis=1)
+  scale = np.sqrt(d) / np.mean(np.linalg.norm(points - center[:, None], axis=0))
+  T = np.identity(d + 1)
+  T[:d, :d] *= scale
+  T[:d, d] = -scale * center
+
+  return T
+
+
+def dltsystem(x, X):
+  """ Returns the DLT equations A p = 0 of every correspondence.
+
+  Args:
+    x: (3 x N) homogeneous 2d image points
+    X: (4 x N) homogeneous 3d world points
+
+  Returns:
+    A: (N x 2 x 12) two rows of the linear system per correspondence
+  """
+
+  n = X.shape[1]
+  A = np.zeros((n, 2, 12))
+  A[:, 0, 0:4] = (x[2] * X).T
+  A[:, 0, 8:12] = -(x[0] * X).T
+  A[:, 1, 4:8] = (x[2] * X).T
+  A[:, 1, 8:12] = -(x[1] * X).T
+
+  return A
+
+
+def normalizeprojection(P):
+  """ Fix the scale and sign of a projection matrix so that ||P[2, :3]|| = 1 and
+  det(P[:, :3]) > 0, as for L.dot(M) from getfullprojection. """
+
+  P = P / np.linalg.norm(P[..., 2:3, :3], axis=-1, keepdims=True)
+  return P * np.sign(np.linalg.det(P[..., :3]))[..., None, None]
+
+
+def calibratedlt(x, X):
+  """ Estimate the projection matrix from 2D-3D correspondences with the
+  normalized direct linear transformation.
+
+  Args:
+    x: (2 x N) 2d image points, N >= 6
+    X: (3 x N) 3d world points
+
+  Returns:
+    P: projection matrix
+  """
+
+  T2, T3 = normalizationmatrix(x), normalizationmatrix(X)
+  A = dltsystem(T2.dot(cart2hom(x)), T3.dot(cart2hom(X))).reshape(-1, 12)
+  P = np.linalg.svd(A, full_matrices=False)[2][-1].reshape(3, 4)
+
+  return normalizeprojection(np.linalg.inv(T2).dot(P).dot(T3))
+
+
+def refineprojection(P, x, X, iterations=50, tol=1e-12):
+  """ Refine a projection matrix by minimizing the reprojection error with
+  Levenberg-Marquardt, using the analytic Jacobian of the projection.
+
+  Args:
+    P: initial projection matrix
+    x: (2 x N) 2d image points
+    X: (3 x N) 3d world points
+    iterations: maximum number of iterations
+    tol: stop when the cost decreases by less than tol relatively
+
+  Returns:
+    P: refined projection matrix
+  """
+
+  # work in normalized coordinates, the image normalization is a similarity
+  # so the residuals stay proportional to the reprojection error in pixels
+  T2, T3 = normalizationmatrix(x), normalizationmatrix(X)
+  xn = T2[:2, :2].dot(x) + T2[:2, 2:]
+  Xh = T3.dot(cart2hom(X))
+  p = T2.dot(P).dot(np.linalg.inv(T3)).ravel()
+  p /= np.linalg.norm(p)
+
+  def project(p):
+    proj = p.reshape(3, 4).dot(Xh)
+    return proj[:2] / proj[2], proj[2]
+
+  u, w = project(p)
+  cost = np.sum((u - xn)**2)
+  damping = 1e-3
+  n = Xh.shape[1]
+  for _ in range(iterations):
+    # derivatives of u = p1 X / p3 X and v = p2 X / p3 X
+    J = np.zeros((2, n, 12))
+    J[0, :, 0:4] = (Xh / w).T
+    J[1, :, 4:8] = (Xh / w).T
+    J[:, :, 8:12] = -(u / w)[:, :, None] * Xh.T
+    J = J.reshape(-1, 12)
+    JtJ = J.T.dot(J)
+    g = J.T.dot((u - xn).ravel())
+
+    while damping < 1e10:
+      step = np.linalg.solve(JtJ + damping * np.diag(np.diag(JtJ)), -g)
+      p_new = (p + step) / np.linalg.norm(p + step)
+      u_new, w_new = project(p_new)
+      cost_new = np.sum((u_new - xn)**2)
+      if cost_new < cost:
+        damping /= 10
+        break
+      damping *= 10
+    else:
+      break
+
+    converged = cost - cost_new <= tol * cost
+    p, u, w, cost = p_new, u_new, w_new, cost_new
+    if converged:
+      break
+
+  return normalizeprojection(np.linalg.inv(T2).dot(p.reshape(3, 4)).dot(T3))
+
+
+def calibrateransac(x, X, iterations=1000, threshold=1.0, seed=None, chunk=64):
+  """ Robust calibration with RANSAC. All minimal-sample hypotheses are
+  estimated with one batched SVD and scored in chunks by projecting every
+  point through every hypothesis of the chunk, the best one is re-estimated
+  on its inliers with calibratedlt and refineprojection.
+
+  Args:
+    x: (2 x N) 2d image points
+    X: (3 x N) 3d world points
+    iterations: number of hypotheses
+    threshold: maximum reprojection error of an inlier in pixels
+    seed: seed of the random number generator
+    chunk: number of hypotheses scored together
+
+  Returns:
+    P: projection matrix
+    inliers: (N,) boolean mask of the inliers of P
+  """
+
+  rng = np.random.default_rng(seed)
+  n = x.shape[1]
+  if n < 6:
+    raise ValueError("calibration needs at least 6 correspondences, got %d" % n)
+  T2, T3 = normalizationmatrix(x), normalizationmatrix(X)
+  A = dltsystem(T2.dot(cart2hom(x)), T3.dot(cart2hom(X)))
+
+  # 6 correspondences per hypothesis, each a (12 x 12) system; rows with
+  # repeated indices are drawn again
+  samples = rng.integers(n, size=(iterations, 6))
+  repeated = np.arange(iterations)
+  while True:
+    ordered = np.sort(samples[repeated], axis=1)
+    repeated = repeated[(ordered[:, 1:] == ordered[:, :-1]).any(axis=1)]
+    if not len(repeated):
+      break
+    samples[repeated] = rng.integers(n, size=(len(repeated), 6))
+  P = np.linalg.svd(A[samples].reshape(iterations, 12, 12))[2][:, -1].reshape(-1, 3, 4)
+  P = np.matmul(np.matmul(np.linalg.inv(T2), P), T3)
+
+  # score chunks of hypotheses at once, keeping the one with most inliers
+  inliers, count = None, -1
+  for c in range(0, iterations, chunk):
+    with np.errstate(divide='ignore', invalid='ignore'):
+      error = np.linalg.norm(projectpointsbatch(P[c:c + chunk], X) - x, axis=1)
+    candidates = error < threshold
+    counts = candidates.sum(axis=1)
+    best = np.argmax(counts)
+    if counts[best] > count:
+      inliers, count = candidates[best], counts[best]
+  if count < 6:
+    raise ValueError("best RANSAC hypothesis has %d inliers, at least 6 are needed" % count)
+
+  P = calibratedlt(x[:, inliers], X[:, inliers])
+  P = refineprojection(P, x[:, inliers], X[:, inliers])
+  inliers = np.linalg.norm(projectpoints(P, X) - x, axis=0) < threshold
+
+  return P, inliers
+
+
+def decomposeprojection(P):
+  """ Decompose a projection matrix into the matrices of getfullprojection,
+  such that getfullprojection(T, Rx, Ry, Rz, L) equals P up to scale.
+
+  Args:
+    P: projection matrix
+
+  Returns:
+    T: translation matrix
+    Rx, Ry, Rz: rotation matrices around the x, y and z axis
+    L: central projection matrix, with separate focal lengths and skew
+      if P was not created by getcentralprojection
+  """
+
+  P = normalizeprojection(P)
+  K, R = scipy.linalg.rq(P[:, :3])
+  D = np.diag(np.sign(np.diag(K)))
+  K, R = K.dot(D), D.dot(R)
+  t = np.linalg.solve(K, P[:, 3])
+
+  # R = Rz Rx Ry, see getrotations
+  dx = np.degrees(np.arcsin(np.clip(R[2, 1], -1, 1)))
+  dy = np.degrees(np.arctan2(-R[2, 0], R[2, 2]))
+  dz = np.degrees(np.arctan2(-R[0, 1], R[1, 1]))
+
+  L = np.zeros((3, 4))
+  L[:, :3] = K / K[2, 2]
+
+  return gettranslation(R.T.dot(t)), getxrotation(dx), getyrotation(dy), getzrotation(dz), L
+
+
 def p3multiplecoice():
   '''
   Change the order of the transformations (translation and rotation).
@@ -266,6 +1017,15 @@ def p3multiplecoice():
   return 0
 
 if __name__ == "__main__":
+    # quaternion round trip, including rotations by 180 degrees
+    axes = np.array([[1, -1, 0], [0, 1, -1], [1, 2, -3], [0, 0, 1]], dtype=np.float64)
+    axes /= np.linalg.norm(axes, axis=1, keepdims=True)
+    angles = np.radians([180, 180, 180, 179.9, 90, 0.1, 0])[:, None]
+    q = np.concatenate([np.cos(angles / 2).repeat(len(axes), 0),
+                        (np.sin(angles / 2)[:, None] * axes).reshape(-1, 3)], axis=1)
+    poses = RigidTransform.fromquaternion(q, np.zeros((len(q), 3)))
+    assert np.allclose(RigidTransform.fromquaternion(poses.quaternion(), poses.t).R, poses.R)
+
     t = np.array([-27.1, -2.9, -3.2])
     principal_point = np.array([8, -10])
     focal_length = 8
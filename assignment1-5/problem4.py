@@ -1,24 +1,70 @@
+import functools
 import math
 import numpy as np
 from scipy import ndimage
 
 
-def gauss2d(sigma, fsize):
+@functools.lru_cache(maxsize=128)
+def gausskernel(sigma, size=None, dtype=np.float64):
+  """ Normalized Gaussian kernel, cached so that repeated calls with the
+  same arguments return the same read-only array.
+
+  Args:
+    sigma: width of the Gaussian, a scalar for a 1D kernel or a tuple
+      (sigma_y, sigma_x) for a 2D kernel
+    size: length of the kernel, or a tuple (H, W) for a 2D kernel,
+      chosen to cover 3 sigma on both sides if not given
+    dtype: dtype of the kernel
+
+  Returns:
+    g: *normalized* Gaussian kernel, (size,) or (H,W)
+  """
+
+  if np.ndim(sigma) == 0:
+    if size is None:
+      size = 2 * int(np.ceil(3 * sigma)) + 1
+    x = np.arange(size) - size // 2
+    if sigma > 0:
+      g = np.exp(-x**2 / (2 * sigma**2))
+    else:
+      g = (x == 0).astype(np.float64)
+    g = (g / g.sum()).astype(dtype)
+  else:
+    sizes = size if np.ndim(size) else (size, size)
+    g = np.outer(gausskernel(sigma[0], sizes[0], dtype),
+                 gausskernel(sigma[1], sizes[1], dtype))
+  g.setflags(write=False)
+
+  return g
+
+
+def kernelkey(sigma, size=None, dtype=np.float64):
+  """ Canonical (sigma, size, dtype) cache key of gausskernel: sigma as a float
+  or a tuple of floats, size as an int or a tuple of ints and a np.dtype, so
+  that lists, arrays and equivalent dtypes share one cache entry.
+  """
+
+  sigma = float(sigma) if np.ndim(sigma) == 0 else tuple(float(s) for s in np.ravel(sigma))
+  if size is not None:
+    size = int(size) if np.ndim(size) == 0 else tuple(int(n) for n in np.ravel(size))
+
+  return sigma, size, np.dtype(dtype)
+
+
+def gauss2d(sigma, fsize=None, dtype=np.float64):
   """
   Args:
-    sigma: width of the Gaussian filter
-    fsize: dimensions of the filter
+    sigma: width of the Gaussian filter, or (sigma_y, sigma_x)
+    fsize: dimensions of the filter, chosen from sigma if not given
 
   Returns:
-    g: *normalized* Gaussian filter
+    g: *normalized* Gaussian filter, (fsize,1) for a scalar sigma and
+      (H,W) for an anisotropic one
   """
 
-  g = np.zeros((fsize, 1))
-  offset = fsize // 2
-  for i in range(-offset, -offset + fsize):
-     g[i + offset] = 1/(np.sqrt(2*np.pi) * sigma) * np.exp(-(i**2) / 2*sigma**2) \
-  
-  g = g / g.sum()
+  g = gausskernel(*kernelkey(sigma, fsize, dtype))
+  if g.ndim == 1:
+    g = g[:, np.newaxis]
 
   return g
 
@@ -50,12 +96,66 @@ def filterimage(I, fx, fy):
     Ix, Iy: images filtered by fx and fy respectively
   """
 
-  Ix = ndimage.convolve(I, fx, mode='constant', cval=0.0)
-  Iy = ndimage.convolve(I, fy, mode='constant', cval=0.0)
+  # integer images go through the 2D convolution, which rounds only once
+  sx, sy = separablefactors(fx), separablefactors(fy)
+  if sx is None or sy is None or not np.issubdtype(I.dtype, np.floating):
+    Ix = ndimage.convolve(I, fx, mode='constant', cval=0.0)
+    Iy = ndimage.convolve(I, fy, mode='constant', cval=0.0)
+    return Ix, Iy
+
+  # rank-one filters: one 1D pass along the columns and one along the rows,
+  # a pass with the same factor in fx and fy is only computed once
+  # the intermediate pass stays in float64, the 2D convolution also
+  # accumulates in double precision
+  (ux, vx), (uy, vy) = sx, sy
+  if samefactor(ux, uy):
+    tmp = convolve1d(I, ux, 0, output=np.float64)
+    Ix, Iy = convolve1d(tmp, vx, 1, output=I.dtype), convolve1d(tmp, vy, 1, output=I.dtype)
+  elif samefactor(vx, vy):
+    tmp = convolve1d(I, vx, 1, output=np.float64)
+    Ix, Iy = convolve1d(tmp, ux, 0, output=I.dtype), convolve1d(tmp, uy, 0, output=I.dtype)
+  else:
+    Ix = convolve1d(convolve1d(I, ux, 0, output=np.float64), vx, 1, output=I.dtype)
+    Iy = convolve1d(convolve1d(I, uy, 0, output=np.float64), vy, 1, output=I.dtype)
 
   return Ix, Iy
 
 
+def separablefactors(f, tol=1e-10):
+  """ Splits a 2D filter into a column and a row filter if it has rank one.
+
+  Args:
+    f: 2D filter
+    tol: tolerance on the second singular value relative to the first one
+
+  Returns:
+    (u, v) with f = outer(u, v), or None if f is not separable
+  """
+
+  U, s, Vt = np.linalg.svd(np.atleast_2d(f))
+  if s.size > 1 and s[1] > tol * s[0]:
+    return None
+  u = U[:, 0] * np.sqrt(s[0])
+  v = Vt[0] * np.sqrt(s[0])
+  # fix the sign so that equal factors of different filters compare equal
+  if u[np.argmax(np.abs(u))] < 0:
+    u, v = -u, -v
+
+  return u, v
+
+
+def samefactor(a, b):
+  """ Checks if two 1D filter factors are equal up to rounding. """
+
+  return a.shape == b.shape and np.allclose(a, b, rtol=1e-12, atol=0)
+
+
+def convolve1d(I, f, axis, output=None):
+  """ 1D convolution along one axis with the border handling of filterimage. """
+
+  return ndimage.convolve1d(I, f, axis=axis, output=output, mode='constant', cval=0.0)
+
+
 def detectedges(Ix, Iy, thr):
   """ Detects edges by applying a threshold on the image gradient magnitude.
 
@@ -84,24 +184,111 @@ def nonmaxsupp(edges, Ix, Iy):
   Returns:
     edges2: edge map where non-maximum edges are suppressed
   """
-  m, n = edges.shape
-  edges2 = np.zeros((m, n))
-  for i in range(1, m-1):
-        for j in range(1, n-1):
-            theta = np.arctan(Iy[i, j] / Ix[i, j]) * 180 / np.pi
-  # handle top-to-bottom edges: theta in [-90, -67.5] or (67.5, 90]
-            if (-90 <= theta <= -67.5) or (67.5 < theta <= 90):
-                  q, r = edges[i-1, j], edges[i+1, j]
-  # handle left-to-right edges: theta in (-22.5, 22.5]
-            elif -22.5 < theta <= 22.5:
-                  q, r = edges[i, j-1], edges[i, j+1]
-  # handle bottomleft-to-topright edges: theta in (22.5, 67.5]
-            elif 22.5 < theta <= 67.5:
-                  q, r = edges[i+1, j-1], edges[i-1, j+1]
-  # handle topleft-to-bottomright edges: theta in [-67.5, -22.5]
-            elif -67.5 <= theta <= -22.5:
-                  q, r = edges[i-1, j-1], edges[i+1, j+1]
-
-            if (edges[i, j] >= q) and (edges[i, j] >= r):
-                  edges2[i, j] = edges[i, j]
-  return edges2        
+  # gradient direction in degrees, Ix == 0 counts as a vertical gradient
+  ratio = np.divide(Iy, Ix, out=np.full(Ix.shape, np.inf), where=Ix != 0)
+  theta = np.degrees(np.arctan(ratio))[1:-1, 1:-1]
+
+  # the two neighbours across the edge for every direction bin:
+  # top-to-bottom: theta in [-90, -67.5] or (67.5, 90]
+  # left-to-right: theta in (-22.5, 22.5]
+  # bottomleft-to-topright: theta in (22.5, 67.5]
+  # topleft-to-bottomright: theta in [-67.5, -22.5]
+  bins = [(theta <= -67.5) | (theta > 67.5),
+          (-22.5 < theta) & (theta <= 22.5),
+          (22.5 < theta) & (theta <= 67.5)]
+  q = np.select(bins, [edges[:-2, 1:-1], edges[1:-1, :-2], edges[2:, :-2]], edges[:-2, :-2])
+  r = np.select(bins, [edges[2:, 1:-1], edges[1:-1, 2:], edges[:-2, 2:]], edges[2:, 2:])
+
+  center = edges[1:-1, 1:-1]
+  edges2 = np.zeros(edges.shape)
+  edges2[1:-1, 1:-1] = np.where((center >= q) & (center >= r), center, 0)
+
+  return edges2
+
+
+def hysteresis(edges, low, high):
+  """ Double-threshold hysteresis: keeps edges above the high threshold and
+  edges above the low threshold that are connected to one of them.
+
+  Args:
+    edges: edge map containing the magnitude of the image gradient at edges and 0 otherwise
+    low, high: the two threshold values
+
+  Returns:
+    edges2: (H,W) boolean edge map
+  """
+
+  # label the 8-connected components of the weak edges at once and keep
+  # every component that contains at least one strong edge
+  weak = (edges > 0) & (edges >= low)
+  labels, nlabels = ndimage.label(weak, structure=np.ones((3, 3)))
+  keep = np.zeros(nlabels + 1, dtype=bool)
+  keep[labels[edges >= high]] = True
+  keep[0] = False
+
+  return keep[labels]
+
+
+def canny(I, low=0.1, high=0.3, fx=None, fy=None):
+  """ Canny edge detector: derivative filtering, non-maximum suppression
+  and hysteresis thresholding.
+
+  Args:
+    I: a (H,W) numpy array storing image data
+    low, high: thresholds on the gradient magnitude for the hysteresis
+    fx, fy: derivative filters, created with createfilters() if not given
+
+  Returns:
+    edges: (H,W) boolean edge map
+  """
+
+  if fx is None or fy is None:
+    fx, fy = createfilters()
+  Ix, Iy = filterimage(I, fx, fy)
+  edges = nonmaxsupp(detectedges(Ix, Iy, low), Ix, Iy)
+
+  return hysteresis(edges, low, high)
+
+
+def scalespaceedges(I, sigmas, thr):
+  """ Detects edges at several scales of a Gaussian scale space.
+
+  Each level is smoothed from the previous one with the remaining
+  sigma sqrt(s_k^2 - s_(k-1)^2), the gradients of all levels are
+  computed in one pass over the stack and scale-normalized by sigma.
+
+  Args:
+    I: a (H,W) numpy array storing image data
+    sigmas: widths of the Gaussian at each scale
+    thr: threshold on the scale-normalized gradient magnitude
+
+  Returns:
+    edges: (S,H,W) edge maps after non-maximum suppression, sorted by increasing sigma
+    combined: (H,W) edge map taking every pixel from the scale with the
+      largest normalized gradient magnitude
+  """
+
+  sigmas = np.sort(np.asarray(sigmas, dtype=np.float64))
+  stack = np.empty((sigmas.size,) + I.shape, dtype=np.result_type(I.dtype, np.float32))
+  # both passes write in the float dtype of the stack, so integer images
+  # are not rounded from level to level
+  level, prev = I, 0.0
+  for k, s in enumerate(sigmas):
+    g = gausskernel(*kernelkey(np.sqrt(s**2 - prev**2)))
+    convolve1d(convolve1d(level, g, 0, output=stack.dtype), g, 1, output=stack[k])
+    level, prev = stack[k], s
+
+  d = np.array([-1, 0, 1])
+  Ix = ndimage.convolve1d(stack, d, axis=2, mode='constant', cval=0.0)
+  Iy = ndimage.convolve1d(stack, d, axis=1, mode='constant', cval=0.0)
+  Ix *= sigmas[:, None, None]
+  Iy *= sigmas[:, None, None]
+
+  edges = np.empty(stack.shape)
+  for k in range(sigmas.size):
+    edges[k] = nonmaxsupp(detectedges(Ix[k], Iy[k], thr), Ix[k], Iy[k])
+
+  best = np.argmax(Ix**2 + Iy**2, axis=0)
+  combined = np.take_along_axis(edges, best[None], axis=0)[0]
+
+  return edges, combined
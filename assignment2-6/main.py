@@ -73,7 +73,7 @@ def problem2():
     show_images(np.stack([test_face, test_face2], 0), hw,  title="Sample images")
 
     # Compute PCA
-    mean_face, u, cumul_var = p2.compute_pca(y)
+    mean_face, u, cumul_var = p2.compute_pca(y, method="thin")
 
     # Compute PCA reconstruction
     # percentiles of total variance
@@ -1,8 +1,10 @@
-from copy import deepcopy
+from functools import lru_cache
+import json
 import numpy as np
+import os
 from PIL import Image
 from scipy.special import binom
-from scipy.ndimage import convolve
+from scipy.ndimage import convolve1d, correlate, correlate1d
 
 
 def loadimg(path):
@@ -14,69 +16,387 @@ def loadimg(path):
         image as (H, W) np.array normalized to [0, 1]
     """
 
-    #
-    # You code here
-    #
+    return np.asarray(Image.open(path).convert("L"), dtype=np.float64) / 255
 
 
-def gauss2d(sigma, fsize):
+def gauss2d(sigma, fsize, factors=False):
     """ Create a 2D Gaussian filter
 
     Args:
         sigma: width of the Gaussian filter
         fsize: (W, H) dimensions of the filter
+        factors: also return the 1D factors of the filter
     Returns:
-        *normalized* Gaussian filter as (H, W) np.array
+        *normalized* Gaussian filter as (H, W) np.array,
+        with factors=True also the column and row factor (H,) and (W,)
     """
 
-    #
-    # You code here
-    #
+    w, h = fsize
+    gy, gx = gauss1d(float(sigma), int(h)), gauss1d(float(sigma), int(w))
+    g = outerkernel(gy, gx)
 
+    return (g, (gy, gx)) if factors else g
 
-def binomial2d(fsize):
+
+def binomial2d(fsize, factors=False):
     """ Create a 2D binomial filter
 
     Args:
         fsize: (W, H) dimensions of the filter
+        factors: also return the 1D factors of the filter
+    Returns:
+        *normalized* binomial filter as (H, W) np.array,
+        with factors=True also the column and row factor (H,) and (W,)
+    """
+
+    w, h = fsize
+    by, bx = binomial1d(int(h)), binomial1d(int(w))
+    b = outerkernel(by, bx)
+
+    return (b, (by, bx)) if factors else b
+
+
+@lru_cache(maxsize=64)
+def gauss1d(sigma, n):
+    """ Normalized 1D Gaussian filter of length n, cached and read-only """
+
+    x = np.arange(n) - (n - 1) / 2
+    g = np.exp(-x**2 / (2 * sigma**2))
+    g /= g.sum()
+    g.setflags(write=False)
+
+    return g
+
+
+@lru_cache(maxsize=64)
+def binomial1d(n):
+    """ Normalized 1D binomial filter of length n, cached and read-only """
+
+    b = binom(n - 1, np.arange(n))
+    b /= b.sum()
+    b.setflags(write=False)
+
+    return b
+
+
+def outerkernel(u, v):
+    """ 2D filter from its column and row factor, cached per factor pair and read-only """
+
+    return cachedouterkernel(u.tobytes(), v.tobytes())
+
+
+@lru_cache(maxsize=64)
+def cachedouterkernel(ukey, vkey):
+    """ Cached part of outerkernel, keyed by the bytes of the factors """
+
+    f = np.outer(np.frombuffer(ukey), np.frombuffer(vkey))
+    f.setflags(write=False)
+
+    return f
+
+
+def separablefactors(f):
+    """ Split a 2D filter into a column and a row factor if it has rank one
+
+    Args:
+        f: 2d filter kernel
     Returns:
-        *normalized* binomial filter as (H, W) np.array
+        (u, v) with f = outer(u, v), or None if f is not separable
     """
 
-    #
-    # You code here
-    #
+    f = np.ascontiguousarray(f, dtype=np.float64)
+    return cachedseparablefactors(f.tobytes(), f.shape)
+
+
+@lru_cache(maxsize=64)
+def cachedseparablefactors(key, shape):
+    """ Cached part of separablefactors, keyed by the bytes and shape of the filter """
+
+    U, s, Vt = np.linalg.svd(np.frombuffer(key).reshape(shape))
+    if s.size > 1 and s[1] > 1e-10 * s[0]:
+        return None
+
+    u, v = U[:, 0] * np.sqrt(s[0]), Vt[0] * np.sqrt(s[0])
+    if u.sum() < 0:
+        u, v = -u, -v
+    u.setflags(write=False)
+    v.setflags(write=False)
 
+    return u, v
 
-def downsample2(img, f):
+
+def downsampleaxis(img, k, axis, out=None):
+    """ Filter a 2D image with a 1D kernel along one axis (mode='mirror')
+    and keep every other sample along that axis
+
+    Args:
+        img: image to downsample
+        k: 1d filter kernel
+        axis: 0 to downsample the rows, 1 to downsample the columns
+        out: optional preallocated output array
+    Returns:
+        image downsampled along axis as np.array
+    """
+
+    if axis == 1:
+        # along the contiguous axis the compiled filter is fastest
+        filtered = convolve1d(img, k, axis=1, mode="mirror")[:, ::2]
+        if out is None:
+            return filtered.copy()
+        out[:] = filtered
+        return out
+
+    # along the rows only the retained rows are computed, each tap is one
+    # multiply-add over whole contiguous rows
+    n, m = len(k), (img.shape[0] + 1) // 2
+    padded = np.pad(img, ((n - 1 - n // 2, n // 2), (0, 0)), mode="reflect")
+    if out is None:
+        out = np.empty((m, img.shape[1]))
+    tmp = np.empty_like(out)
+    out[:] = 0
+    for a, c in enumerate(k[::-1]):
+        np.multiply(padded[a:a + 2 * m:2], c, out=tmp)
+        out += tmp
+
+    return out
+
+
+def upsampleaxis(img, k, axis, out=None):
+    """ Polyphase upsampling of a 2D image by a factor of 2 along one axis
+    with a 1D kernel, the 1D counterpart of upsample2
+
+    Args:
+        img: image to upsample
+        k: 1d filter kernel
+        axis: 0 to upsample the rows, 1 to upsample the columns
+        out: optional preallocated output array
+    Returns:
+        image upsampled along axis as np.array
+    """
+
+    n, m = len(k), img.shape[axis]
+    p = n // 2 + 1
+    if out is None:
+        shape = list(img.shape)
+        shape[axis] *= 2
+        out = np.empty(shape)
+    if axis == 0:
+        padded = np.pad(img, ((p, p), (0, 0)), mode="reflect")
+        tmp = np.empty(img.shape)
+    else:
+        padded = np.pad(img, ((0, 0), (p, p)), mode="reflect")
+
+    for r in range(2):
+        # taps of k that hit the non-zero samples of output phase r,
+        # out[2i + r] = 2 sum_e taps[e] img[i + d + e]
+        last = n - 1 - (n - 1 - r - n // 2) % 2
+        phase = out[r::2] if axis == 0 else out[:, r::2]
+        if last < 0:
+            phase[:] = 0
+            continue
+        d = (r + n // 2 - last) // 2
+        taps = 2 * k[last::-1][::2]
+
+        if axis == 1:
+            start = p + d + len(taps) // 2
+            phase[:] = correlate1d(padded, taps, axis=1, mode="constant")[:, start:start + m]
+            continue
+
+        phase[:] = 0
+        for e, c in enumerate(taps):
+            np.multiply(padded[p + d + e:p + d + e + m], c, out=tmp)
+            phase += tmp
+
+    return out
+
+
+def downsample2(img, f, out=None):
     """ Downsample image by a factor of 2
     Filter with Gaussian filter then take every other row/column
 
     Args:
         img: image to downsample
         f: 2d filter kernel
+        out: optional preallocated output array
     Returns:
         downsampled image as (H, W) np.array
     """
 
-    #
-    # You code here
-    #
+    h, w = (img.shape[0] + 1) // 2, (img.shape[1] + 1) // 2
+    if out is None:
+        out = np.empty((h, w))
+
+    # evaluate the convolution (mode='mirror') only at the retained samples:
+    # with the flipped kernel g, out[i, j] = sum_ab g[a, b] padded[2i + a, 2j + b],
+    # which splits into four correlations of the even/odd rows/columns of
+    # padded with the even/odd taps of g
+    factors = separablefactors(f)
+    if factors is not None:
+        # rank-one filter: filter and subsample the columns, then the rows
+        return downsampleaxis(downsampleaxis(img, factors[1], 1), factors[0], 0, out=out)
+
+    kh, kw = f.shape
+    g = f[::-1, ::-1]
+    padded = np.pad(img, ((kh - 1 - kh // 2, kh // 2), (kw - 1 - kw // 2, kw // 2)), mode="reflect")
+    out[:] = 0
+    for r in range(min(kh, 2)):
+        for s in range(min(kw, 2)):
+            out += correlatevalid(padded[r::2, s::2], g[r::2, s::2], (h, w))
 
+    return out
 
-def upsample2(img, f):
+
+def upsample2(img, f, out=None):
     """ Upsample image by factor of 2
 
     Args:
         img: image to upsample
         f: 2d filter kernel
+        out: optional preallocated output array (2H, 2W)
     Returns:
         upsampled image as (H, W) np.array
     """
 
-    #
-    # You code here
-    #
+    h, w = img.shape
+    if out is None:
+        out = np.empty((2 * h, 2 * w))
+
+    # polyphase filtering: only every other sample of the zero-stuffed image is
+    # non-zero, so output phase (r, s) is a correlation of img with the taps of
+    # f that hit those samples, out[2i + r] = 4 sum_d f[r + c - 2d] img[i + d]
+    factors = separablefactors(f)
+    if factors is not None:
+        # rank-one filter: upsample the columns, then the rows
+        return upsampleaxis(upsampleaxis(img, factors[1], 1), factors[0], 0, out=out)
+
+    kh, kw = f.shape
+    ph, pw = kh // 2 + 1, kw // 2 + 1
+    padded = np.pad(img, ((ph, ph), (pw, pw)), mode="reflect")
+    for r in range(2):
+        for s in range(2):
+            # last tap with the parity of the phase, none for a 1-tap side
+            ar = kh - 1 - (kh - 1 - r - kh // 2) % 2
+            bs = kw - 1 - (kw - 1 - s - kw // 2) % 2
+            if ar < 0 or bs < 0:
+                out[r::2, s::2] = 0
+                continue
+            di, dj = (r + kh // 2 - ar) // 2, (s + kw // 2 - bs) // 2
+            phase = 4 * f[ar::-2, bs::-2]
+            out[r::2, s::2] = correlatevalid(padded[ph + di:, pw + dj:], phase, (h, w))
+
+    return out
+
+
+def correlatevalid(img, f, shape):
+    """ Correlation without border handling, out[i, j] = sum_ab f[a, b] img[i + a, j + b]
+
+    Args:
+        img: image to filter
+        f: 2d filter kernel
+        shape: (H, W) of the returned top left part of the result
+    Returns:
+        filtered image as (H, W) np.array
+    """
+
+    h, w = shape
+    kh, kw = f.shape
+    filtered = correlate(img[:h + kh - 1, :w + kw - 1], f, mode="constant")
+
+    return filtered[kh // 2:kh // 2 + h, kw // 2:kw // 2 + w]
+
+
+def pyramidshapes(shape, nlevel):
+    """ Shapes of the levels of an image pyramid, halving (rounded up) per level
+
+    Args:
+        shape: (H, W) shape of the finest level
+        nlevel: number of pyramid levels
+    Returns:
+        list of (H, W) tuples sorted from fine to coarse
+    """
+
+    shapes = [tuple(shape)]
+    for _ in range(nlevel - 1):
+        shapes.append(((shapes[-1][0] + 1) // 2, (shapes[-1][1] + 1) // 2))
+
+    return shapes
+
+
+def pyramidpath(path):
+    """ Path of a saved pyramid buffer, with the .npy suffix np.save adds """
+
+    return path if path.endswith(".npy") else path + ".npy"
+
+
+class Pyramid(object):
+    """ Image pyramid stored in a single (H, W) buffer laid out like the
+    composite image: levels from fine to coarse left to right, aligned at the
+    top and padded with zeros on the bottom. The levels are views into the
+    buffer, so the pyramid behaves like a list of (H, W) np.array levels.
+    """
+
+    __slots__ = ("buffer", "levels")
+
+    def __init__(self, shape, nlevel, buffer=None):
+        shapes = pyramidshapes(shape, nlevel)
+        if buffer is None:
+            buffer = np.zeros((shapes[0][0], sum(w for _, w in shapes)))
+        self.buffer = buffer
+        self.levels = []
+        x = 0
+        for h, w in shapes:
+            self.levels.append(buffer[:h, x:x + w])
+            x += w
+
+    def __len__(self):
+        return len(self.levels)
+
+    def __getitem__(self, k):
+        return self.levels[k]
+
+    def __setitem__(self, k, value):
+        self.levels[k][...] = value
+
+    def __iter__(self):
+        return iter(self.levels)
+
+    def copy(self):
+        return Pyramid(self.levels[0].shape, len(self), self.buffer.copy())
+
+    def save(self, path):
+        """ Save the pyramid buffer as a single .npy file, with the finest
+        shape and the number of levels in a .json file next to it
+        """
+
+        path = pyramidpath(path)
+        np.save(path, self.buffer)
+        with open(os.path.splitext(path)[0] + ".json", "w") as fp:
+            json.dump({"shape": list(self.levels[0].shape), "nlevel": len(self)}, fp)
+
+    @classmethod
+    def load(cls, path, nlevel=None, mmap_mode=None):
+        """ Load a pyramid saved with save(), optionally memory mapped
+
+        Args:
+            path: path to the .npy file
+            nlevel: expected number of pyramid levels, checked if given
+            mmap_mode: passed on to np.load, e.g. "r" to map the file read-only
+        Returns:
+            Pyramid with levels viewing the loaded buffer
+        """
+
+        path = pyramidpath(path)
+        with open(os.path.splitext(path)[0] + ".json") as fp:
+            meta = json.load(fp)
+        if nlevel is not None and nlevel != meta["nlevel"]:
+            raise ValueError("%s holds %d pyramid levels, not %d" % (path, meta["nlevel"], nlevel))
+
+        buffer = np.load(path, mmap_mode=mmap_mode)
+        shapes = pyramidshapes(meta["shape"], meta["nlevel"])
+        if buffer.shape != (shapes[0][0], sum(w for _, w in shapes)):
+            raise ValueError("buffer of shape %s does not match the pyramid of %s" % (buffer.shape, path))
+
+        return cls(shapes[0], meta["nlevel"], buffer)
 
 
 def gaussianpyramid(img, nlevel, f):
@@ -87,13 +407,18 @@ def gaussianpyramid(img, nlevel, f):
         nlevel: number of pyramid levels
         f: 2d filter kernel
     Returns:
-        Gaussian pyramid, pyramid levels as (H, W) np.array
-        in a list sorted from fine to coarse
+        Gaussian pyramid, Pyramid with levels as (H, W) np.array
+        views sorted from fine to coarse
     """
 
-    #
-    # You code here
-    #
+    # filter each level straight into its view of the single pyramid buffer
+    gpyramid = Pyramid(img.shape, nlevel)
+
+    gpyramid[0] = img
+    for k in range(1, nlevel):
+        downsample2(gpyramid[k - 1], f, out=gpyramid[k])
+
+    return gpyramid
 
 
 def laplacianpyramid(gpyramid, f):
@@ -103,13 +428,22 @@ def laplacianpyramid(gpyramid, f):
         gpyramid: Gaussian pyramid
         f: 2d filter kernel
     Returns:
-        Laplacian pyramid, pyramid levels as (H, W) np.array
-        in a list sorted from fine to coarse
+        Laplacian pyramid, Pyramid with levels as (H, W) np.array
+        views sorted from fine to coarse
     """
 
-    #
-    # You code here
-    #
+    h, w = gpyramid[0].shape
+    scratch = np.empty((h + 1, w + 1))
+    lpyramid = Pyramid((h, w), len(gpyramid))
+
+    for k in range(len(gpyramid) - 1):
+        h, w = gpyramid[k].shape
+        coarse = gpyramid[k + 1]
+        up = upsample2(coarse, f, out=scratch[:2 * coarse.shape[0], :2 * coarse.shape[1]])
+        np.subtract(gpyramid[k], up[:h, :w], out=lpyramid[k])
+    lpyramid[-1] = gpyramid[-1]
+
+    return lpyramid
 
 
 def reconstructimage(lpyramid, f):
@@ -122,28 +456,43 @@ def reconstructimage(lpyramid, f):
         Reconstructed image as (H, W) np.array clipped to [0, 1]
     """
 
-    #
-    # You code here
-    #
+    h, w = lpyramid[0].shape
+    scratch = np.empty((h + 1, w + 1))
+    img = lpyramid[-1].copy()
+
+    for level in lpyramid[-2::-1]:
+        h, w = level.shape
+        up = upsample2(img, f, out=scratch[:2 * img.shape[0], :2 * img.shape[1]])
+        img = level + up[:h, :w]
 
+    return np.clip(img, 0, 1, out=img)
 
-def amplifyhighfreq(lpyramid, l0_factor=1.0, l1_factor=1.0):
+
+def amplifyhighfreq(lpyramid, l0_factor=1.0, l1_factor=1.0, inplace=False):
     """ Amplify frequencies of the finest two layers of the Laplacian pyramid
 
     Args:
         lpyramid: Laplacian pyramid
         l0_factor: amplification factor for the finest pyramid level
         l1_factor: amplification factor for the second finest pyramid level
+        inplace: scale the levels of lpyramid itself instead of a copy
     Returns:
         Amplified Laplacian pyramid, data format like input pyramid
     """
 
-    #
-    # You code here
-    #
+    if inplace:
+        amplified = lpyramid
+    elif isinstance(lpyramid, Pyramid):
+        amplified = lpyramid.copy()
+    else:
+        amplified = [level.copy() for level in lpyramid]
+    amplified[0] *= l0_factor
+    amplified[1] *= l1_factor
+
+    return amplified
 
 
-def createcompositeimage(pyramid):
+def createcompositeimage(pyramid, normalize=True):
     """ Create composite image from image pyramid
     Arrange from finest to coarsest image left to right, pad images with
     zeros on the bottom to match the hight of the finest pyramid level.
@@ -151,10 +500,26 @@ def createcompositeimage(pyramid):
 
     Args:
         pyramid: image pyramid
+        normalize: normalize the levels, without it the buffer of a
+            Pyramid is returned as is
     Returns:
         composite image as (H, W) np.array
     """
 
-    #
-    # You code here
-    #
+    if isinstance(pyramid, Pyramid) and not normalize:
+        return pyramid.buffer
+
+    h = pyramid[0].shape[0]
+    composite = np.zeros((h, sum(level.shape[1] for level in pyramid)))
+
+    x = 0
+    for level in pyramid:
+        lh, lw = level.shape
+        if normalize:
+            lo, hi = level.min(), level.max()
+            composite[:lh, x:x + lw] = (level - lo) / (hi - lo) if hi > lo else 0
+        else:
+            composite[:lh, x:x + lw] = level
+        x += lw
+
+    return composite
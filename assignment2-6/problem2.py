@@ -1,27 +1,113 @@
+import json
 import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
 
-def load_faces(path, ext=".pgm"):
+def face_files(path, ext):
+    """List the face images below path in a fixed order
+
+    Args:
+        path: path to the directory with face images
+        ext: extension of the image files
+
+    Returns:
+        files: sorted list of (relative path, mtime in ns, size in bytes)
+    """
+
+    files = []
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            if name.endswith(ext):
+                full = os.path.join(root, name)
+                stat = os.stat(full)
+                files.append((os.path.relpath(full, path), stat.st_mtime_ns, stat.st_size))
+
+    return sorted(files)
+
+
+def load_faces(path, ext=".pgm", workers=4, cache=True, labels=False, dtype=np.float64):
     """Load faces into an array (N, H, W),
     where N is the number of face images and
     H, W are height and width of the images.
     
-    Hint: os.walk() supports recursive listing of files 
-    and directories in a path
+    The images are decoded by a thread pool straight into a preallocated
+    array. With cache=True the array is written to <path>/faces.npy together
+    with a manifest <path>/faces.json of the file paths and mtimes, and later
+    calls memory map the cache (copy-on-write) unless the files changed.
+    If the cache cannot be written, e.g. on a read-only dataset, the images
+    are only decoded into memory.
     
     Args:
         path: path to the directory with face images
         ext: extension of the image files (you can assume .pgm only)
+        workers: number of decoding threads
+        cache: read and write the .npy cache of the decoded images
+        labels: also return the subject label of every image
+        dtype: data type of the returned array
     
     Returns:
         imgs: (N, H, W) numpy array
+        subjects: (N, ) numpy array of the names of the directories
+        holding the images, only with labels=True
     """
     
-    #
-    # You code here
-    #
+    files = face_files(path, ext)
+    if not files:
+        raise ValueError("no %s images found in %s" % (ext, path))
+    subjects = np.array([os.path.basename(os.path.dirname(f)) for f, _, _ in files])
+
+    cachefile = os.path.join(path, "faces.npy")
+    manifestfile = os.path.join(path, "faces.json")
+    manifest = {"dtype": np.dtype(dtype).str, "files": [list(f) for f in files]}
+
+    imgs = None
+    if cache and os.path.exists(cachefile) and os.path.exists(manifestfile):
+        with open(manifestfile) as fp:
+            if json.load(fp) == manifest:
+                imgs = np.load(cachefile, mmap_mode="c")
+
+    if imgs is None:
+        with Image.open(os.path.join(path, files[0][0])) as im:
+            w, h = im.size
+        shape = (len(files), h, w)
+        if cache:
+            # decode straight into the cache file, the manifest is only
+            # written once it is complete
+            try:
+                imgs = np.lib.format.open_memmap(cachefile, mode="w+", dtype=dtype, shape=shape)
+            except OSError:
+                # read-only dataset, decode into memory without a cache
+                cache = False
+        if not cache:
+            imgs = np.empty(shape, dtype=dtype)
+
+        def decode(i):
+            with Image.open(os.path.join(path, files[i][0])) as im:
+                if im.size != (w, h):
+                    raise ValueError("image %s has size %s, expected %s" % (files[i][0], im.size, (w, h)))
+                imgs[i] = np.asarray(im)
+
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(decode, range(len(files))))
+
+        if cache:
+            imgs.flush()
+            try:
+                with open(manifestfile, "w") as fp:
+                    json.dump(manifest, fp)
+            except OSError:
+                imgs = np.array(imgs)
+            else:
+                # hand out the same copy-on-write map as a cache hit, edits
+                # by the caller must not reach the file
+                del imgs
+                imgs = np.load(cachefile, mmap_mode="c")
+
+    if labels:
+        return imgs, subjects
+    return imgs
 
 
 def vectorize_images(imgs):
@@ -37,26 +123,225 @@ def vectorize_images(imgs):
         x: (N, M) numpy array
     """
     
-    #
-    # You code here
-    #
+    return imgs.reshape(imgs.shape[0], -1)
+
 
+def randomized_svd(Xc, rank, oversample=10, niter=4, seed=None):
+    """Randomized SVD of a centered data matrix (Halko et al.)
 
-def compute_pca(X):
+    Args:
+        Xc: (N, M) numpy array, centered data
+        rank: number of singular vectors to compute
+        oversample: number of additional random directions
+        niter: number of power iterations
+        seed: seed of the random projection
+
+    Returns:
+        s: (rank, ) numpy array, singular values in descending order
+        v: (M, rank) numpy array, right singular vectors
+    """
+
+    rng = np.random.default_rng(seed)
+    k = min(rank + oversample, *Xc.shape)
+    omega = rng.standard_normal((Xc.shape[1], k)).astype(Xc.dtype, copy=False)
+
+    # range of Xc, with power iterations to separate the singular values
+    q, _ = np.linalg.qr(Xc @ omega)
+    for _ in range(niter):
+        q, _ = np.linalg.qr(Xc.T @ q)
+        q, _ = np.linalg.qr(Xc @ q)
+
+    _, s, vt = np.linalg.svd(q.T @ Xc, full_matrices=False)
+
+    return s[:rank], vt[:rank].T
+
+
+def compute_pca(X, method="full", p=None, rank=None, dtype=None, seed=None):
     """PCA implementation
     
+    method="full" returns the full (M, M) basis. The truncated methods
+    return at most min(N, M) components: "thin" takes the eigenvectors of the
+    (N, N) Gram matrix when N < M and a thin SVD otherwise, "randomized" a
+    randomized SVD. With p or rank only the components basis(u, cumul_var, p)
+    would keep, or the first rank components, are returned.
+    
     Args:
         X: (N, M) an numpy array with N M-dimensional features
+        method: "full", "thin" or "randomized"
+        p: fraction of the total variance the components should account for
+        rank: maximum number of components
+        dtype: computation data type, by default float64 for "full"
+        and float32 for the truncated methods
+        seed: seed of the randomized SVD
     
     Returns:
         mean_face: (M,) numpy array representing the mean face
         u: (M, M) numpy array, bases with D principal components
         cumul_var: (N, ) numpy array, corresponding cumulative variance
+        as a fraction of the total variance
+    """
+
+    if dtype is None:
+        dtype = np.float64 if method == "full" else np.float32
+    X = np.asarray(X, dtype=dtype)
+    mean_face = X.mean(axis=0)
+    Xc = X - mean_face
+
+    # the variance along a component is its squared singular value over N,
+    # the fractions only need the squared singular values
+    total = np.einsum("ij,ij->", Xc, Xc, dtype=np.float64)
+
+    if method == "full":
+        _, s, vt = np.linalg.svd(Xc, full_matrices=True)
+        u = vt.T
+        var = s ** 2
+    elif method == "thin":
+        if Xc.shape[0] < Xc.shape[1]:
+            # accumulate the Gram matrix in float64, squaring the data in
+            # float32 would lose the weak components
+            gram = np.zeros((Xc.shape[0], Xc.shape[0]))
+            for j in range(0, Xc.shape[1], 1024):
+                block = Xc[:, j:j + 1024].astype(np.float64)
+                gram += block @ block.T
+            lam, w = np.linalg.eigh(gram)
+            lam, w = lam[::-1], w[:, ::-1]
+            keep = lam > lam[0] * np.finfo(np.float64).eps * len(lam)
+            var = lam[keep]
+            u = (Xc.T @ w[:, keep].astype(dtype)) / np.sqrt(var).astype(dtype)
+        else:
+            _, s, vt = np.linalg.svd(Xc, full_matrices=False)
+            u = vt.T
+            var = s ** 2
+    elif method == "randomized":
+        maxrank = min(Xc.shape)
+        k = min(rank or 32, maxrank)
+        while True:
+            s, u = randomized_svd(Xc, k, seed=seed)
+            var = s ** 2
+            # grow the rank until the requested variance fraction is covered
+            if rank is not None or p is None or k == maxrank or var.sum() >= p * total:
+                break
+            k = min(2 * k, maxrank)
+    else:
+        raise ValueError("unknown PCA method %r" % (method,))
+
+    cumul_var = np.cumsum(var) / total
+
+    if method != "full" and (p is not None or rank is not None):
+        d = len(cumul_var)
+        if p is not None:
+            d = min(d, np.searchsorted(cumul_var, p) + 1)
+        if rank is not None:
+            d = min(d, rank)
+        u, cumul_var = np.ascontiguousarray(u[:, :d]), cumul_var[:d]
+
+    return mean_face, u, cumul_var
+
+
+class IncrementalPCA(object):
+    """PCA updated with mini-batches of face vectors (incremental SVD,
+    Ross et al.), so new faces extend the basis without refitting.
+    Memory is bounded by rank and the batch size, not by the number of faces.
+
+    Args:
+        rank: maximum number of components to keep, by default the size of
+        the first batch
+        dtype: data type of the components
     """
 
-    #
-    # You code here
-    #
+    def __init__(self, rank=None, dtype=np.float64):
+        self.rank = rank
+        self.dtype = dtype
+        self.n = 0
+        self.mean_face = None
+        self.s = None
+        self.v = None
+        self.total = 0.0
+
+    def partial_fit(self, X):
+        """Update the mean, components and variance with a batch of faces
+
+        Args:
+            X: (B, M) numpy array with B M-dimensional features
+
+        Returns:
+            self
+        """
+
+        X = np.asarray(X, dtype=self.dtype)
+        b = X.shape[0]
+        if b == 0:
+            return self
+        if self.rank is None:
+            self.rank = min(X.shape)
+
+        batch_mean = X.mean(axis=0)
+        Xc = X - batch_mean
+        total = np.einsum("ij,ij->", Xc, Xc, dtype=np.float64)
+
+        if self.n == 0:
+            stacked = Xc
+            mean_face = batch_mean
+        else:
+            # previous components scaled by their singular values, the new
+            # centered batch and a row correcting for the shift of the mean
+            shift = np.sqrt(self.n * b / (self.n + b)) * (self.mean_face - batch_mean)
+            stacked = np.vstack((self.s[:, None] * self.v, Xc, shift))
+            total += shift @ shift
+            mean_face = self.mean_face + (batch_mean - self.mean_face) * (b / (self.n + b))
+
+        _, s, vt = np.linalg.svd(stacked, full_matrices=False)
+        self.s, self.v = s[:self.rank], vt[:self.rank]
+        self.mean_face = mean_face
+        self.total += total
+        self.n += b
+
+        return self
+
+    def fit(self, batches):
+        """Update the PCA with all batches of an iterable or generator
+
+        Args:
+            batches: iterable of (B, M) numpy arrays
+
+        Returns:
+            self
+        """
+
+        for X in batches:
+            self.partial_fit(X)
+
+        return self
+
+    def result(self):
+        """Return the PCA in the format of compute_pca
+
+        Returns:
+            mean_face: (M,) numpy array representing the mean face
+            u: (M, D) numpy array, bases with D principal components
+            cumul_var: (D, ) numpy array, cumulative variance
+            as a fraction of the total variance
+        """
+
+        return self.mean_face, self.v.T, np.cumsum(self.s ** 2) / self.total
+
+
+def compute_pca_incremental(batches, rank=None, dtype=np.float64):
+    """PCA of mini-batches of face vectors from an iterable or generator
+
+    Args:
+        batches: iterable of (B, M) numpy arrays
+        rank: maximum number of components to keep
+        dtype: data type of the components
+
+    Returns:
+        mean_face: (M,) numpy array representing the mean face
+        u: (M, D) numpy array, bases with D principal components
+        cumul_var: (D, ) numpy array, cumulative variance
+        as a fraction of the total variance
+    """
+
+    return IncrementalPCA(rank, dtype).fit(batches).result()
 
 
 def basis(u, cumul_var, p = 0.5):
@@ -77,9 +362,11 @@ def basis(u, cumul_var, p = 0.5):
     
     """
     
-    #
-    # You code here
-    #
+    # cumul_var is the cumulative fraction of the total variance, so the
+    # first component reaching p closes the basis
+    d = min(np.searchsorted(cumul_var, p) + 1, len(cumul_var), u.shape[1])
+
+    return u[:, :d]
 
 
 def compute_coefficients(face_image, mean_face, u):
@@ -96,9 +383,7 @@ def compute_coefficients(face_image, mean_face, u):
         a: (D, ) numpy array, containing the coefficients
     """
     
-    #
-    # You code here
-    #
+    return (face_image - mean_face) @ u
 
 
 def reconstruct_image(a, mean_face, u):
@@ -117,9 +402,40 @@ def reconstruct_image(a, mean_face, u):
         principal components
     """
     
-    #
-    # You code here
-    #
+    return mean_face + u @ a
+
+
+def normalize_rows(a):
+    """Scale the rows of a to unit L2 norm, leaving zero rows at zero
+
+    Args:
+        a: (N, D) numpy array
+
+    Returns:
+        a: (N, D) numpy array with unit rows
+    """
+
+    norms = np.linalg.norm(a, axis=-1, keepdims=True)
+
+    return a / np.maximum(norms, np.finfo(a.dtype).tiny)
+
+
+def top_k(sim, k):
+    """Indices of the k largest similarities along the last axis
+
+    Args:
+        sim: (..., N) numpy array of similarities
+        k: number of indices to return
+
+    Returns:
+        idx: (..., k) numpy array of indices sorted by decreasing similarity
+    """
+
+    k = min(k, sim.shape[-1])
+    idx = np.argpartition(-sim, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(sim, idx, -1), axis=-1, kind="stable")
+
+    return np.take_along_axis(idx, order, -1)
 
 
 def compute_similarity(Y, x, u, mean_face):
@@ -136,9 +452,10 @@ def compute_similarity(Y, x, u, mean_face):
         sim: (N, ) numpy array containing the cosine similarity values
     """
 
-    #
-    # You code here
-    #
+    gallery = normalize_rows(compute_coefficients(Y, mean_face, u))
+    query = normalize_rows(compute_coefficients(x, mean_face, u))
+
+    return gallery @ query
 
 
 def search(Y, x, u, mean_face, top_n):
@@ -157,9 +474,259 @@ def search(Y, x, u, mean_face, top_n):
         sorted by similarity
     """
 
-    #
-    # You code here
-    #
+    return Y[top_k(compute_similarity(Y, x, u, mean_face), top_n)]
+
+
+def project_normalized(Y, mean_face, u, chunk=4096):
+    """Unit coefficient vectors of faces, projected in chunks of rows
+
+    Args:
+        Y: (N, M) numpy array with N M-dimensional features
+        mean_face: (M, ) numpy array, mean face as a vector
+        u: (M, D) bases vectors
+        chunk: number of faces projected at once
+
+    Returns:
+        a: (N, D) numpy array of unit coefficient vectors
+    """
+
+    a = np.empty((len(Y), u.shape[1]), dtype=np.result_type(Y, u))
+    for j in range(0, len(Y), chunk):
+        a[j:j + chunk] = normalize_rows(compute_coefficients(Y[j:j + chunk], mean_face, u))
+
+    return a
+
+
+def top_k_similarity(gallery, queries, top_n, qchunk=256, nchunk=4096, workers=None):
+    """Cosine top-k of unit query vectors in a gallery of unit vectors
+
+    The similarities are computed as GEMMs of query chunks against gallery
+    shards, so at most (qchunk, nchunk) similarities are held per shard.
+    Each shard keeps its own top_n, the candidates of all shards are merged.
+
+    Args:
+        gallery: (N, D) numpy array of unit vectors
+        queries: (Q, D) numpy array of unit vectors
+        top_n: number of matches per query
+        qchunk: number of queries per chunk
+        nchunk: number of gallery vectors per shard
+        workers: number of threads for the gallery shards, None runs serially
+
+    Returns:
+        idx: (Q, top_n) numpy array, gallery indices sorted by similarity
+        sim: (Q, top_n) numpy array, their cosine similarity
+    """
+
+    k = min(top_n, len(gallery))
+    idx = np.empty((len(queries), k), dtype=np.int64)
+    sim = np.empty((len(queries), k), dtype=np.result_type(gallery, queries))
+    shards = range(0, len(gallery), nchunk)
+    if not len(shards):
+        return idx, sim
+
+    def shard_top(query, j):
+        s = query @ gallery[j:j + nchunk].T
+        i = top_k(s, k)
+        return i + j, np.take_along_axis(s, i, -1)
+
+    pool = ThreadPoolExecutor(workers) if workers else None
+    try:
+        for q in range(0, len(queries), qchunk):
+            query = queries[q:q + qchunk]
+            if pool is None:
+                parts = [shard_top(query, j) for j in shards]
+            else:
+                parts = list(pool.map(lambda j: shard_top(query, j), shards))
+            candidates = np.concatenate([i for i, _ in parts], axis=1)
+            scores = np.concatenate([s for _, s in parts], axis=1)
+            best = top_k(scores, k)
+            idx[q:q + qchunk] = np.take_along_axis(candidates, best, -1)
+            sim[q:q + qchunk] = np.take_along_axis(scores, best, -1)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return idx, sim
+
+
+def search_batch(Y, X, u, mean_face, top_n, qchunk=256, nchunk=4096, workers=None):
+    """Search for the top most similar images of many queries at once
+    
+    Args:
+        Y: (N, M) numpy array with N M-dimensional features
+        X: (Q, M) numpy array, images we would like to retrieve
+        u: (M, D) numpy arrray, bases vectors. Note, we already assume D has been selected.
+        mean_face: (M, ) numpy array, mean face as a vector
+        top_n: integer, number of matches per query
+        qchunk: number of queries per chunk
+        nchunk: number of gallery images per shard
+        workers: number of threads for the gallery shards, None runs serially
+    
+    Returns:
+        idx: (Q, top_n) numpy array, indices into Y sorted by similarity
+        sim: (Q, top_n) numpy array, their cosine similarity
+    """
+
+    gallery = project_normalized(Y, mean_face, u, nchunk)
+    queries = project_normalized(X, mean_face, u, qchunk)
+
+    return top_k_similarity(gallery, queries, top_n, qchunk, nchunk, workers)
+
+
+class FaceIndex(object):
+    """Gallery of faces projected once onto the PCA basis.
+
+    The coefficients are kept L2-normalized in a contiguous float32 array,
+    so a cosine query is one matrix-vector product and an argpartition,
+    independent of the image dimension M. Every face keeps the id it got
+    from add(), queries return those ids.
+
+    Args:
+        u: (M, D) numpy array, bases vectors
+        mean_face: (M, ) numpy array, mean face as a vector
+        Y: optional (N, M) numpy array of initial gallery faces
+        dtype: data type of the coefficients
+    """
+
+    def __init__(self, u, mean_face, Y=None, dtype=np.float32):
+        self.u = np.ascontiguousarray(u, dtype=dtype)
+        self.mean_face = np.asarray(mean_face, dtype=dtype)
+        self.coeffs = np.empty((0, self.u.shape[1]), dtype=dtype)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.n = 0
+        self.next_id = 0
+        if Y is not None:
+            self.add(Y)
+
+    def __len__(self):
+        return self.n
+
+    def project(self, Y):
+        """Normalized coefficients of faces
+
+        Args:
+            Y: (N, M) or (M, ) numpy array of faces
+
+        Returns:
+            (N, D) or (D, ) numpy array of unit coefficient vectors
+        """
+
+        Y = np.asarray(Y, dtype=self.u.dtype)
+
+        return normalize_rows(compute_coefficients(Y, self.mean_face, self.u))
+
+    def add(self, Y):
+        """Add faces to the gallery
+
+        Args:
+            Y: (N, M) numpy array of faces
+
+        Returns:
+            ids: (N, ) numpy array, ids of the added faces
+        """
+
+        a = self.project(np.atleast_2d(Y))
+        b = len(a)
+        if self.n + b > len(self.coeffs) or not self.coeffs.flags.writeable:
+            # grow geometrically, this also copies a memory mapped gallery
+            capacity = max(2 * len(self.coeffs), self.n + b)
+            coeffs = np.empty((capacity, a.shape[1]), dtype=self.coeffs.dtype)
+            ids = np.empty(capacity, dtype=np.int64)
+            coeffs[:self.n] = self.coeffs[:self.n]
+            ids[:self.n] = self.ids[:self.n]
+            self.coeffs, self.ids = coeffs, ids
+
+        ids = np.arange(self.next_id, self.next_id + b)
+        self.coeffs[self.n:self.n + b] = a
+        self.ids[self.n:self.n + b] = ids
+        self.n += b
+        self.next_id += b
+
+        return ids
+
+    def remove(self, ids):
+        """Remove faces from the gallery
+
+        Args:
+            ids: ids of the faces to remove
+        """
+
+        keep = ~np.isin(self.ids[:self.n], ids)
+        self.coeffs = np.ascontiguousarray(self.coeffs[:self.n][keep])
+        self.ids = self.ids[:self.n][keep]
+        self.n = len(self.ids)
+
+    def query(self, x, top_n):
+        """Find the most similar faces in the gallery
+
+        Args:
+            x: (M, ) numpy array, image we would like to retrieve
+            top_n: number of faces to return
+
+        Returns:
+            ids: (top_n, ) numpy array, ids of the faces sorted by similarity
+            sim: (top_n, ) numpy array, their cosine similarity
+        """
+
+        sim = self.coeffs[:self.n] @ self.project(x)
+        idx = top_k(sim, top_n)
+
+        return self.ids[idx], sim[idx]
+
+    def query_batch(self, X, top_n, qchunk=256, nchunk=4096, workers=None):
+        """Find the most similar faces in the gallery for many queries
+
+        Args:
+            X: (Q, M) numpy array, images we would like to retrieve
+            top_n: number of faces to return per query
+            qchunk: number of queries per chunk
+            nchunk: number of gallery faces per shard
+            workers: number of threads for the gallery shards, None runs serially
+
+        Returns:
+            ids: (Q, top_n) numpy array, ids of the faces sorted by similarity
+            sim: (Q, top_n) numpy array, their cosine similarity
+        """
+
+        queries = project_normalized(np.asarray(X, dtype=self.u.dtype), self.mean_face, self.u, qchunk)
+        idx, sim = top_k_similarity(self.coeffs[:self.n], queries, top_n, qchunk, nchunk, workers)
+
+        return self.ids[idx], sim
+
+    def save(self, path):
+        """Save the index as .npy files and the next id as meta.json
+        in the directory path"""
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "u.npy"), self.u)
+        np.save(os.path.join(path, "mean_face.npy"), self.mean_face)
+        np.save(os.path.join(path, "coeffs.npy"), self.coeffs[:self.n])
+        np.save(os.path.join(path, "ids.npy"), self.ids[:self.n])
+        with open(os.path.join(path, "meta.json"), "w") as fp:
+            json.dump({"next_id": self.next_id}, fp)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """Load an index saved with save(), memory mapped by default
+
+        Args:
+            path: directory of the index
+            mmap_mode: passed on to np.load
+
+        Returns:
+            FaceIndex
+        """
+
+        index = cls(np.load(os.path.join(path, "u.npy"), mmap_mode=mmap_mode),
+                    np.load(os.path.join(path, "mean_face.npy")))
+        index.coeffs = np.load(os.path.join(path, "coeffs.npy"), mmap_mode=mmap_mode)
+        index.ids = np.load(os.path.join(path, "ids.npy"))
+        index.n = len(index.ids)
+        # ids of removed faces stay retired, so next_id is saved separately
+        with open(os.path.join(path, "meta.json")) as fp:
+            index.next_id = json.load(fp)["next_id"]
+
+        return index
 
 
 def interpolate(x1, x2, u, mean_face, n):
@@ -181,6 +748,7 @@ def interpolate(x1, x2, u, mean_face, n):
         image; Y[0] == project(x1, u); Y[-1] == project(x2, u)
     """
 
-    #
-    # You code here
-    #
+    a = np.linspace(compute_coefficients(x1, mean_face, u),
+                    compute_coefficients(x2, mean_face, u), n)
+
+    return mean_face + a @ u.T